@@ -3,6 +3,14 @@ __version__ = '0.1.0'
 __author__ = '@obahamonde'  
 
 from fastapi import FastAPI, Request
+from src.config import env, sessions
+from src.api.state import container_index
+from src.api.cloudflare import dns_index
+from src.api.metrics import stats_sampler
+from src.api.nginx import routes
+from src.jobs import jobs
+from src.executor import executor
+from src.model.provision import aprovision_models
 from src.router import containers, workers, domains, build
 
 def create_app():
@@ -17,6 +25,37 @@ def create_app():
     app.include_router(workers.app, prefix='/workers', tags=['workers'])
     app.include_router(domains.app, prefix='/domains', tags=['domains'])
 
+    @app.on_event('startup')
+    async def startup():
+        await sessions.startup()
+        if env.CONTAINER_CACHE:
+            await container_index.start()
+        await dns_index.start()
+        try:
+            # the table starts empty: read our conf files back, then match the running apps
+            await routes.load()
+            if env.NGINX_SYNC_ON_STARTUP:
+                print(f"Route sync: {await build.sync_routes(prune=True)}")
+        except Exception as exc:
+            print(f"Route sync failed: {exc!r}")
+        if env.STATS_SAMPLER:
+            await stats_sampler.start()
+        if env.FAUNA_SECRET and env.FAUNA_PROVISION:
+            try:
+                report = await aprovision_models(
+                    dry_run=env.FAUNA_PROVISION_DRY_RUN, timeout=env.FAUNA_PROVISION_TIMEOUT
+                )
+                print(f"Fauna provisioning: {report}")
+            except Exception as exc:
+                print(f"Fauna provisioning failed: {exc!r}")
+
+    @app.on_event('shutdown')
+    async def shutdown():
+        await jobs.shutdown()
+        await stats_sampler.stop()
+        await container_index.stop()
+        await dns_index.stop()
+        await sessions.shutdown()
+        executor.shutdown()
 
-    
     return app
\ No newline at end of file
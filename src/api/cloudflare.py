@@ -1,4 +1,17 @@
-from src.config import env, fetch
+import re
+import json
+import time
+import uuid
+import random
+import asyncio
+import hashlib
+import aiohttp
+from typing import Any, Dict, List, Literal, Optional, Tuple
+from pydantic import BaseModel, Field
+from src.config import env, fetch_response
+from src.utils import gather_limited
+
+CF_API = env.CF_API_URL
 
 CF_HEADERS = {
     "X-Auth-Email": env.CF_EMAIL,
@@ -6,91 +19,651 @@ CF_HEADERS = {
     "Content-Type": "application/json",
 }
 
+CF_AUTH_HEADERS = {key: value for key, value in CF_HEADERS.items() if key != "Content-Type"}
+
+MODULE_PATTERN = re.compile(r"^\s*export\s+default\b", re.MULTILINE)
+
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+
+class TokenBucket:
+    """
+    Request budget of `capacity` calls per `period` seconds.
+    Callers wait in line for a token once the budget runs out, so calls are paced
+    instead of rejected; a 429 `pause`s the bucket for the time the API asked for.
+    """
+
+    def __init__(self, capacity: int, period: float):
+        self.capacity = capacity
+        self.rate = capacity / period
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    @property
+    def lock(self) -> asyncio.Lock:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.paused_until = max(self.paused_until, self.updated + seconds)
+
+    @property
+    def remaining(self) -> int:
+        self._refill()
+        return int(self.tokens)
+
+
+class CloudflareClient:
+    """
+    Rate-limit aware wrapper around `fetch` for the Cloudflare API.
+    - Every call takes a token from the bucket first.
+    - 429s pause the bucket for `Retry-After` and are retried.
+    - Idempotent calls are retried on 5xx and connection errors with jittered exponential backoff.
+    - Identical GETs in flight at the same time share one request.
+    """
+
+    def __init__(self, bucket: TokenBucket, retries: int, backoff: float = 0.5, max_backoff: float = 8.0):
+        self.bucket = bucket
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._inflight: Dict[Tuple[str, str], "asyncio.Future[Any]"] = {}
+
+    def _delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    async def request(
+        self,
+        url: str,
+        method: str = "GET",
+        json: Optional[Dict[str, Any]] = None,
+        body: Optional[Any] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> Any:
+        if method != "GET" or json is not None or body is not None:
+            return await self._send(url, method, json, body, headers)
+        key = (url, repr(sorted((headers or {}).items())))
+        future = self._inflight.get(key)
+        if future is None:
+            future = self._inflight[key] = asyncio.ensure_future(
+                self._send(url, method, json, body, headers)
+            )
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _send(
+        self,
+        url: str,
+        method: str,
+        json: Optional[Dict[str, Any]],
+        body: Optional[Any],
+        headers: Optional[Dict[str, str]],
+    ) -> Any:
+        idempotent = method in IDEMPOTENT_METHODS
+        attempt = 0
+        while True:
+            await self.bucket.acquire()
+            try:
+                status, response_headers, payload = await fetch_response(
+                    url, method, headers=headers or CF_HEADERS, body=body, json=json
+                )
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if not idempotent or attempt >= self.retries:
+                    raise
+                await asyncio.sleep(self._delay(attempt))
+                attempt += 1
+                continue
+            if status == 429 and attempt < self.retries:
+                try:
+                    retry_after = float(response_headers.get("Retry-After", ""))
+                except ValueError:
+                    retry_after = self._delay(attempt)
+                self.bucket.pause(retry_after)
+                attempt += 1
+                continue
+            if status >= 500 and idempotent and attempt < self.retries:
+                await asyncio.sleep(self._delay(attempt))
+                attempt += 1
+                continue
+            return payload
+
+
+client = CloudflareClient(TokenBucket(env.CF_RATE_LIMIT, env.CF_RATE_PERIOD), env.CF_RETRIES)
+
+
+def script_hash(script: str) -> str:
+    return hashlib.sha256(script.encode()).hexdigest()
+
+def is_module(script: str) -> bool:
+    """ES module workers `export default` their handlers, service workers use `addEventListener`"""
+    return MODULE_PATTERN.search(script) is not None
+
+def multipart_script(script: str) -> Tuple[bytes, str]:
+    """
+    Encode a script as a multipart upload: a `metadata` part naming the script part
+    (`main_module` for ES modules, `body_part` otherwise) followed by the script itself.
+    :return: The body and its Content-Type.
+    """
+    boundary = uuid.uuid4().hex
+    if is_module(script):
+        part, content_type, metadata = "worker.js", "application/javascript+module", {"main_module": "worker.js"}
+    else:
+        part, content_type, metadata = "script", "application/javascript", {"body_part": "script"}
+    body = b"".join(
+        [
+            f"--{boundary}\r\n".encode(),
+            b'Content-Disposition: form-data; name="metadata"; filename="metadata.json"\r\n',
+            b"Content-Type: application/json\r\n\r\n",
+            json.dumps(metadata).encode(),
+            f"\r\n--{boundary}\r\n".encode(),
+            f'Content-Disposition: form-data; name="{part}"; filename="{part}"\r\n'.encode(),
+            f"Content-Type: {content_type}\r\n\r\n".encode(),
+            script.encode(),
+            f"\r\n--{boundary}--\r\n".encode(),
+        ]
+    )
+    return body, f"multipart/form-data; boundary={boundary}"
 
-async def update_worker(name: str, script: str):
+async def upload_worker(name: str, script: str, method: str = "PUT"):
     """
-    Update a worker.
+    Send a script, embedded in JSON or, past WORKER_MULTIPART_THRESHOLD bytes, as a
+    multipart upload to the script's own URL (which creates or replaces it).
     """
+    if len(script.encode()) >= env.WORKER_MULTIPART_THRESHOLD:
+        body, content_type = multipart_script(script)
+        return await client.request(
+            f"{CF_API}/zones/{env.CF_ZONE_ID}/workers/scripts/{name}",
+            method="PUT",
+            body=body,
+            headers={**CF_AUTH_HEADERS, "Content-Type": content_type},
+        )
     payload = {"name": name, "script": script}
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/workers/scripts/{name}",
-        method="PUT",
-        headers=CF_HEADERS,
+    url = f"{CF_API}/zones/{env.CF_ZONE_ID}/workers/scripts"
+    return await client.request(
+        url if method == "POST" else f"{url}/{name}",
+        method=method,
         json=payload,
     )
 
+async def deploy_worker(name: str, script: str, method: str = "PUT", force: bool = False):
+    """
+    Upload a script unless the manifest says the same bytes are already deployed.
+    The response carries `uploaded` (whether anything was sent) and the script `hash`.
+    """
+    digest = script_hash(script)
+    if not force and await worker_manifest.deployed_hash(name) == digest:
+        return {
+            "success": True,
+            "errors": [],
+            "messages": [],
+            "result": {"id": name},
+            "uploaded": False,
+            "hash": digest,
+        }
+    res = await upload_worker(name, script, method)
+    ok = isinstance(res, dict) and bool(res.get("success"))
+    if ok:
+        worker_manifest.put(name, digest, (res.get("result") or {}).get("etag"))
+    if isinstance(res, dict):
+        res["uploaded"] = ok
+        res["hash"] = digest
+    return res
+
+async def update_worker(name: str, script: str, force: bool = False):
+    """
+    Update a worker, skipping the upload when the script hasn't changed.
+    """
+    return await deploy_worker(name, script, "PUT", force)
+
 async def invoke_worker(name: str):
     """
     Invoke a worker.
     """
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/workers/scripts/{name}/subdomain",
+    return await client.request(
+        f"{CF_API}/zones/{env.CF_ZONE_ID}/workers/scripts/{name}/subdomain",
         method="POST",
-        headers=CF_HEADERS,
     )
 
+async def list_workers():
+    return await client.request(f"{CF_API}/zones/{env.CF_ZONE_ID}/workers/scripts")
+
 async def get_workers():
     """
-    Get all workers.
+    Get all workers, reseeding the manifest from the listing.
     """
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/workers/scripts",
-        headers=CF_HEADERS,
-    )
+    res = await list_workers()
+    worker_manifest.seed(res)
+    return res
 
-async def create_worker(name: str, script: str):
+async def create_worker(name: str, script: str, force: bool = False):
     """
-    Create a worker.
+    Create a worker, skipping the upload when the same script is already deployed under that name.
     """
-    payload = {"name": name, "script": script}
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/workers/scripts",
-        method="POST",
-        headers=CF_HEADERS,
-        json=payload,
-    )
+    return await deploy_worker(name, script, "POST", force)
 
 async def delete_worker(name: str):
     """
     Delete a worker.
     """
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/workers/scripts/{name}",
+    res = await client.request(
+        f"{CF_API}/zones/{env.CF_ZONE_ID}/workers/scripts/{name}",
         method="DELETE",
-        headers=CF_HEADERS,
     )
+    if isinstance(res, dict) and res.get("success"):
+        worker_manifest.drop(name)
+    return res
+
+def dns_payload(name: str) -> Dict[str, Any]:
+    return {"type": "A", "name": name, "content": env.DOCKER_IP, "ttl": 1, "proxied": True}
 
 async def create_dns_record(name: str):
     """
     Create a record.
     """
-    payload =  {"type": "A", "name": name, "content": env.DOCKER_IP, "ttl": 1, "proxied": True}
+    payload = dns_payload(name)
     
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/dns_records",
+    res = await client.request(
+        f"{CF_API}/zones/{env.CF_ZONE_ID}/dns_records",
         "POST",
-        headers=CF_HEADERS,
         json=payload,
     )
+    if res.get("success"):
+        dns_index.put(res["result"])
+    return res
 
-async def get_dns_records():
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/dns_records",
-        headers=CF_HEADERS,
-    )
+async def list_dns_records() -> List[Dict[str, Any]]:
+    """
+    Fetch every record of the zone, following the pagination of the list endpoint.
+    """
+    records: List[Dict[str, Any]] = []
+    page = 1
+    while True:
+        res = await client.request(
+            f"{CF_API}/zones/{env.CF_ZONE_ID}/dns_records?per_page=5000&page={page}"
+        )
+        if not res.get("success"):
+            raise CloudflareError(res.get("errors"))
+        records.extend(res["result"])
+        if page >= (res.get("result_info") or {}).get("total_pages", 1):
+            return records
+        page += 1
+
+async def get_zone_name() -> str:
+    res = await client.request(f"{CF_API}/zones/{env.CF_ZONE_ID}")
+    if not res.get("success"):
+        raise CloudflareError(res.get("errors"))
+    return res["result"]["name"]
+
+async def get_dns_records(fresh: bool = False):
+    """
+    Get all records, served from the record index.
+    """
+    records = await dns_index.records(fresh=fresh)
+    return {"success": True, "errors": [], "messages": [], "result": records}
+
+async def get_dns_record_by_name(name: str, type: str = "A"):
+    """
+    Find a record by its name (either the subdomain or the full name) and type.
+    """
+    return await dns_index.get(name, type)
 
 async def delete_dns_record(record_id: str):
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/dns_records/{record_id}",
+    res = await client.request(
+        f"{CF_API}/zones/{env.CF_ZONE_ID}/dns_records/{record_id}",
         "DELETE",
-        headers=CF_HEADERS,
     )
+    if res.get("success"):
+        dns_index.drop(record_id)
+    return res
 
 async def update_dns_record(record_id: str, name: str):
-    payload = {"type": "A", "name": name, "content": env.DOCKER_IP, "ttl": 1, "proxied": True}
-    return await fetch(
-        f"https://api.cloudflare.com/client/v4/zones/{env.CF_ZONE_ID}/dns_records/{record_id}",
+    payload = dns_payload(name)
+    res = await client.request(
+        f"{CF_API}/zones/{env.CF_ZONE_ID}/dns_records/{record_id}",
         "PUT",
-        headers=CF_HEADERS,
         json=payload,
     )
+    if res.get("success"):
+        dns_index.put(res["result"])
+    return res
+
+async def ensure_dns_record(name: str):
+    """
+    Idempotent upsert of the A record of `name`: nothing is sent when the record
+    already points at the docker host, otherwise one create or update. A create that
+    fails because the record appeared since the last refresh reloads the index and updates it.
+    The response carries an `action` of "unchanged", "created" or "updated".
+    """
+    record = await dns_index.get(name, "A")
+    if record is None:
+        res = await create_dns_record(name)
+        if res.get("success"):
+            res["action"] = "created"
+            return res
+        # created outside this process since the last refresh: reload and update it instead
+        await dns_index.refresh()
+        record = await dns_index.get(name, "A")
+        if record is None:
+            return res
+    if all(record.get(key) == value for key, value in dns_payload(name).items() if key != "name"):
+        return {"success": True, "errors": [], "messages": [], "result": record, "action": "unchanged"}
+    res = await update_dns_record(record["id"], name)
+    if res.get("success"):
+        res["action"] = "updated"
+    return res
+
+
+class DNSOperation(BaseModel):
+    op: Literal["create", "update", "delete"] = Field(..., example="create")
+    name: Optional[str] = Field(default=None, example="my-app")
+    id: Optional[str] = Field(default=None, description="Record id, the A record of `name` is looked up when omitted")
+
+
+class WorkerOperation(BaseModel):
+    op: Literal["create", "update", "delete"] = Field(..., example="update")
+    name: str = Field(..., example="my-worker")
+    script: Optional[str] = Field(default=None)
+
+
+def _outcome(operation: BaseModel, res: Any) -> Dict[str, Any]:
+    ok = isinstance(res, dict) and bool(res.get("success"))
+    outcome = {**operation.dict(exclude={"script"}), "success": ok}
+    if ok:
+        outcome["result"] = res.get("result")
+        if "uploaded" in res:
+            outcome["uploaded"] = res["uploaded"]
+    else:
+        outcome["errors"] = res.get("errors") if isinstance(res, dict) else res
+    return outcome
+
+async def _apply_dns_operation(operation: DNSOperation) -> Any:
+    if operation.op == "create":
+        return await create_dns_record(operation.name)
+    if operation.op == "update":
+        return await update_dns_record(operation.id, operation.name)
+    return await delete_dns_record(operation.id)
+
+async def batch_dns_records(operations: List[DNSOperation]) -> List[Dict[str, Any]]:
+    """
+    Apply many record creates, updates and deletes.
+    Sent as one call to the batch DNS endpoint (applied atomically by Cloudflare),
+    falling back to individual calls, at most CF_BATCH_CONCURRENCY at a time,
+    when the endpoint isn't available.
+    :return: One result per operation, in order.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(operations)
+    pending: List[Tuple[int, DNSOperation]] = []
+    for i, operation in enumerate(operations):
+        if operation.op != "delete" and not operation.name:
+            results[i] = _outcome(operation, {"success": False, "errors": ["name is required"]})
+            continue
+        if operation.op != "create" and not operation.id:
+            # operations only manage A records, never a TXT or MX record sharing the name
+            record = await dns_index.get(operation.name, "A") if operation.name else None
+            if record is None:
+                results[i] = _outcome(operation, {"success": False, "errors": ["record not found"]})
+                continue
+            operation = operation.copy(update={"id": record["id"]})
+        pending.append((i, operation))
+    if not pending:
+        return results
+    body: Dict[str, List[Dict[str, Any]]] = {"deletes": [], "puts": [], "posts": []}
+    slots: Dict[str, List[int]] = {"deletes": [], "puts": [], "posts": []}
+    for i, operation in pending:
+        if operation.op == "delete":
+            key, item = "deletes", {"id": operation.id}
+        elif operation.op == "update":
+            key, item = "puts", {"id": operation.id, **dns_payload(operation.name)}
+        else:
+            key, item = "posts", dns_payload(operation.name)
+        body[key].append(item)
+        slots[key].append(i)
+    res = await client.request(
+        f"{CF_API}/zones/{env.CF_ZONE_ID}/dns_records/batch", "POST", json=body
+    )
+    if not _batch_supported(res):
+        done = await gather_limited(
+            [_apply_dns_operation(operation) for _, operation in pending],
+            env.CF_BATCH_CONCURRENCY,
+        )
+        for (i, operation), item in zip(pending, done):
+            results[i] = _outcome(operation, item)
+        return results
+    operations_by_index = dict(pending)
+    if not res.get("success"):
+        for i, operation in pending:
+            results[i] = _outcome(operation, res)
+        return results
+    for key, indexes in slots.items():
+        records = (res.get("result") or {}).get(key) or []
+        for position, i in enumerate(indexes):
+            operation = operations_by_index[i]
+            record = records[position] if position < len(records) else {"id": operation.id}
+            if key == "deletes":
+                dns_index.drop(operation.id)
+            else:
+                dns_index.put(record)
+            results[i] = _outcome(operation, {"success": True, "result": record})
+    return results
+
+def _batch_supported(res: Any) -> bool:
+    """False when the batch route doesn't exist (non-JSON answer or Cloudflare's 'no route' codes)"""
+    if not isinstance(res, dict):
+        return False
+    codes = {error.get("code") for error in res.get("errors") or [] if isinstance(error, dict)}
+    return not codes & {7000, 7003}
+
+async def _apply_worker_operation(operation: WorkerOperation) -> Any:
+    if operation.op == "delete":
+        return await delete_worker(operation.name)
+    if operation.script is None:
+        return {"success": False, "errors": ["script is required"]}
+    if operation.op == "create":
+        return await create_worker(operation.name, operation.script)
+    return await update_worker(operation.name, operation.script)
+
+async def batch_workers(operations: List[WorkerOperation]) -> List[Dict[str, Any]]:
+    """
+    Apply many worker creates, updates and deletes, at most CF_BATCH_CONCURRENCY at a time.
+    :return: One result per operation, in order.
+    """
+    done = await gather_limited(
+        [_apply_worker_operation(operation) for operation in operations],
+        env.CF_BATCH_CONCURRENCY,
+    )
+    return [_outcome(operation, res) for operation, res in zip(operations, done)]
+
+
+class CloudflareError(Exception):
+    """Cloudflare answered with success=false"""
+
+
+class DNSIndex:
+    """
+    The DNS records of the zone keyed by id and by (type, name): a name can hold records
+    of several types (A next to TXT or MX) and only the A record is the app's.
+    Loaded by auto-paginating the list endpoint, refreshed in the background once
+    older than `ttl` seconds (stale data is served meanwhile), and updated in place
+    by our own create, update and delete calls.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self.by_name: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.zone: Optional[str] = None
+        self.loaded_at: Optional[float] = None
+        self._refreshing: Optional["asyncio.Task[None]"] = None
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    async def start(self) -> None:
+        """Keep the index warm with a refresh every `ttl` seconds"""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"DNS index refresh failed: {exc!r}")
+            await asyncio.sleep(self.ttl)
+
+    @property
+    def stale(self) -> bool:
+        return self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl
+
+    async def refresh(self) -> None:
+        """Reload every record, sharing the request with concurrent callers"""
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._load())
+            self._refreshing.add_done_callback(lambda _: setattr(self, "_refreshing", None))
+        await asyncio.shield(self._refreshing)
+
+    async def _load(self) -> None:
+        if self.zone is None:
+            self.zone = await get_zone_name()
+        records = await list_dns_records()
+        self.by_id = {record["id"]: record for record in records}
+        self.by_name = {(record["type"], record["name"]): record for record in records}
+        self.loaded_at = time.monotonic()
+
+    async def ensure_loaded(self, fresh: bool = False) -> None:
+        if fresh or self.loaded_at is None:
+            await self.refresh()
+        elif self.stale and self._refreshing is None:
+            asyncio.ensure_future(self.refresh()).add_done_callback(
+                lambda task: task.cancelled() or task.exception()
+            )
+
+    def fqdn(self, name: str) -> str:
+        if self.zone is None or name == self.zone or name.endswith(f".{self.zone}"):
+            return name
+        return f"{name}.{self.zone}"
+
+    def put(self, record: Dict[str, Any]) -> None:
+        previous = self.by_id.get(record["id"])
+        if previous is not None:
+            self.by_name.pop((previous["type"], previous["name"]), None)
+        self.by_id[record["id"]] = record
+        self.by_name[(record["type"], record["name"])] = record
+
+    def drop(self, record_id: str) -> None:
+        record = self.by_id.pop(record_id, None)
+        if record is not None:
+            self.by_name.pop((record["type"], record["name"]), None)
+
+    async def records(self, fresh: bool = False) -> List[Dict[str, Any]]:
+        await self.ensure_loaded(fresh)
+        return list(self.by_id.values())
+
+    async def get(self, name: str, type: str = "A") -> Optional[Dict[str, Any]]:
+        """Record of `type` for a subdomain or full name"""
+        await self.ensure_loaded()
+        return self.by_name.get((type, self.fqdn(name)))
+
+
+dns_index = DNSIndex(env.DNS_CACHE_TTL)
+
+
+class WorkerManifest:
+    """
+    sha256 of the script deployed under each worker name, so identical uploads can be skipped.
+    Seeded from the workers listing: a listed worker we haven't uploaded ourselves is
+    downloaded and hashed once, the first time a deploy needs it. Our uploads and deletes
+    update it in place; a listing whose etag differs from the one we recorded forgets the hash.
+    """
+
+    def __init__(self):
+        self.hashes: Dict[str, Optional[str]] = {}
+        self.etags: Dict[str, Optional[str]] = {}
+        self.loaded = False
+        self._loading: Optional["asyncio.Future[None]"] = None
+
+    def seed(self, res: Any) -> None:
+        """Sync the known names with a listing response"""
+        if not isinstance(res, dict) or not res.get("success"):
+            return
+        listed: Dict[str, Optional[str]] = {}
+        for script in res.get("result") or []:
+            name = script.get("id") or script.get("name")
+            if name:
+                listed[name] = script.get("etag")
+        for name in list(self.hashes):
+            if name not in listed:
+                self.drop(name)
+        for name, etag in listed.items():
+            if name not in self.hashes or (etag and etag != self.etags.get(name)):
+                self.hashes[name] = None
+            self.etags[name] = etag
+        self.loaded = True
+
+    async def ensure_loaded(self) -> None:
+        if self.loaded:
+            return
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(list_workers())
+            self._loading.add_done_callback(lambda _: setattr(self, "_loading", None))
+        self.seed(await asyncio.shield(self._loading))
+
+    async def _download_hash(self, name: str) -> Optional[str]:
+        content = await client.request(f"{CF_API}/zones/{env.CF_ZONE_ID}/workers/scripts/{name}")
+        if isinstance(content, bytes):
+            return hashlib.sha256(content).hexdigest()
+        if isinstance(content, str):
+            return script_hash(content)
+        return None
+
+    async def deployed_hash(self, name: str) -> Optional[str]:
+        """Hash of the live script of `name`, None when it doesn't exist or can't be known"""
+        await self.ensure_loaded()
+        if name not in self.hashes:
+            return None
+        if self.hashes[name] is None:
+            self.hashes[name] = await self._download_hash(name)
+        return self.hashes[name]
+
+    def put(self, name: str, digest: str, etag: Optional[str] = None) -> None:
+        self.hashes[name] = digest
+        self.etags[name] = etag
+
+    def drop(self, name: str) -> None:
+        self.hashes.pop(name, None)
+        self.etags.pop(name, None)
+
+
+worker_manifest = WorkerManifest()
@@ -1,7 +1,11 @@
-import asyncio
+import re
+import json
+from enum import Enum
+from contextlib import asynccontextmanager
 from typing import *
-from aiohttp import ClientSession
-from src.config import env, fetch
+from aiohttp import ClientResponse, ClientSession
+from src.config import env, sessions, DOCKER_SOCKET_URL
+from src.utils import gather_limited
 from pydantic import BaseModel, Field
 
 
@@ -15,24 +19,350 @@ class ContainerConfig(BaseModel):
     protocol: str = Field(default="tcp", example="tcp")
 
 
-async def pull_image(image: str):
-    return await fetch(f"{env.DOCKER_URL}/images/create?fromImage={image}", "POST")
+class DockerEngine:
+    """
+    Docker Engine API client.
+    Talks to the daemon through the pooled docker session, either over a unix socket
+    (`unix:///var/run/docker.sock`) or tcp (`http://host:2375`), and can iterate
+    over chunked responses (build output, pull progress, logs, events) without buffering them.
+    """
+
+    def __init__(self, url: Optional[str] = None, upstream: str = "docker"):
+        self._url = url
+        self.upstream = upstream
+
+    @property
+    def url(self) -> str:
+        return self._url or env.DOCKER_URL
+
+    @property
+    def base_url(self) -> str:
+        if self.url.startswith("unix://"):
+            return DOCKER_SOCKET_URL
+        return self.url.rstrip("/")
+
+    @property
+    def session(self) -> ClientSession:
+        return sessions.session(self.upstream)
+
+    @asynccontextmanager
+    async def open(
+        self,
+        method: str,
+        path: str,
+        params: Optional[Dict[str, Any]] = None,
+        json: Optional[Any] = None,
+        data: Optional[Any] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> AsyncIterator[ClientResponse]:
+        """Open a request against the daemon and yield the unread response"""
+        async with self.session.request(
+            method,
+            f"{self.base_url}{path}",
+            params=params,
+            json=json,
+            data=data,
+            headers=headers,
+        ) as response:
+            yield response
+
+    async def request(self, method: str, path: str, **kwargs: Any) -> Any:
+        """Send a request and return the decoded body"""
+        _, body = await self.call(method, path, **kwargs)
+        return body
+
+    async def call(self, method: str, path: str, **kwargs: Any) -> Tuple[int, Any]:
+        """Send a request and return the status code and the decoded body"""
+        async with self.open(method, path, **kwargs) as response:
+            if response.content_type.endswith("json"):
+                return response.status, await response.json()
+            if response.content_type.startswith("text/"):
+                return response.status, await response.text()
+            return response.status, await response.read()
+
+    async def stream(self, method: str, path: str, **kwargs: Any) -> AsyncIterator[bytes]:
+        """Iterate over the raw chunks of a streamed response"""
+        async with self.open(method, path, **kwargs) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_any():
+                yield chunk
+
+    async def stream_json(self, method: str, path: str, **kwargs: Any) -> AsyncIterator[Dict[str, Any]]:
+        """Iterate over a JSON-lines response one message at a time"""
+        async with self.open(method, path, **kwargs) as response:
+            if response.status >= 400:
+                body = await response.text()
+                try:
+                    yield {"error": json.loads(body).get("message", body)}
+                except ValueError:
+                    yield {"error": body}
+                return
+            buffer = b""
+            async for chunk in response.content.iter_any():
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if line.strip():
+                        yield json.loads(line)
+            if buffer.strip():
+                yield json.loads(buffer)
+
+    async def create(self, name: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        return await self.request("POST", "/containers/create", params={"name": name}, json=payload)
+
+    async def start(self, container: str) -> Any:
+        return await self.request("POST", f"/containers/{container}/start")
+
+    async def stop(self, container: str, timeout: Optional[int] = None) -> Any:
+        params = {"t": timeout} if timeout is not None else None
+        return await self.request("POST", f"/containers/{container}/stop", params=params)
+
+    async def restart(self, container: str, timeout: Optional[int] = None) -> Any:
+        params = {"t": timeout} if timeout is not None else None
+        return await self.request("POST", f"/containers/{container}/restart", params=params)
+
+    async def remove(self, container: str, force: bool = False) -> Any:
+        params = {"force": 1} if force else None
+        return await self.request("DELETE", f"/containers/{container}", params=params)
+
+    async def inspect(self, container: str) -> Dict[str, Any]:
+        return await self.request("GET", f"/containers/{container}/json")
+
+    async def list(self, params: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        return await self.request("GET", "/containers/json", params=params or {"all": 1})
+
+    def logs(self, container: str, **params: Any) -> AsyncIterator[bytes]:
+        """Stream the raw (multiplexed) log output of a container"""
+        params = {"stdout": 1, "stderr": 1, **params}
+        return self.stream("GET", f"/containers/{container}/logs", params=params)
+
+    async def stats(self, container: str) -> Dict[str, Any]:
+        """One-shot stats sample"""
+        return await self.request("GET", f"/containers/{container}/stats", params={"stream": 0})
+
+    def stream_stats(self, container: str) -> AsyncIterator[Dict[str, Any]]:
+        """Stream a stats sample per second"""
+        return self.stream_json("GET", f"/containers/{container}/stats", params={"stream": 1})
+
+    def events(self, **params: Any) -> AsyncIterator[Dict[str, Any]]:
+        """Stream daemon events (`since`, `until`, `filters`)"""
+        return self.stream_json("GET", "/events", params=params)
+
+    def build(
+        self,
+        params: Optional[Dict[str, Any]] = None,
+        data: Optional[Any] = None,
+        headers: Optional[Dict[str, str]] = None,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """Stream the JSON messages of an image build"""
+        return self.stream_json("POST", "/build", params=params, data=data, headers=headers)
+
+    def pull(self, image: str, tag: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Stream the progress messages of an image pull (images/create)"""
+        params = {"fromImage": image}
+        if tag:
+            params["tag"] = tag
+        return self.stream_json("POST", "/images/create", params=params)
+
+
+engine = DockerEngine()
+
+STEP_PATTERN = re.compile(r"^Step \d+/\d+ : ")
+
+
+def build_event(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Normalize a message of the docker build stream, None for ones clients don't need (BuildKit traces)"""
+    if "error" in message:
+        return {"type": "error", "error": message["error"], "detail": message.get("errorDetail")}
+    aux = message.get("aux")
+    if isinstance(aux, dict) and "ID" in aux:
+        return {"type": "image", "id": aux["ID"]}
+    if "stream" in message:
+        text = message["stream"]
+        return {"type": "step" if STEP_PATTERN.match(text) else "log", "message": text}
+    if "status" in message:
+        return {
+            "type": "progress",
+            "status": message["status"],
+            "id": message.get("id"),
+            "progress": message.get("progressDetail"),
+        }
+    return None
+
+async def build_events(messages: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+    """Incrementally turn a docker build stream into step/log/progress/error/image events"""
+    async for message in messages:
+        event = build_event(message)
+        if event is not None:
+            yield event
+
+async def build_result(events: AsyncIterator[Dict[str, Any]]) -> Union[str, Dict[str, Any]]:
+    """Consume build events, returning the image id (from `aux.ID`) or the error"""
+    image = None
+    async for event in events:
+        if event["type"] == "error":
+            return {"error": event["error"]}
+        if event["type"] == "image":
+            image = event["id"]
+    return image or {"error": "Build finished without an image id"}
+
+
+async def pull_image(image: str) -> Dict[str, Any]:
+    """Pull an image and return the last progress message"""
+    status: Dict[str, Any] = {}
+    async for message in engine.pull(image):
+        status = message
+        if "error" in message:
+            break
+    return status
 
 async def start_container(container: str):
-    return await fetch(f"{env.DOCKER_URL}/containers/{container}/start", "POST")
+    return await engine.start(container)
 
 async def get_container(container: str):
-    return await fetch(f"{env.DOCKER_URL}/containers/{container}/json")
+    return await engine.inspect(container)
+
+LOG_STREAMS = {0: "stdin", 1: "stdout", 2: "stderr"}
+
+MAX_LOG_LINE = 1 << 16
+
+
+class LogDemuxer:
+    """
+    Incremental parser of the log stream of a container, fed chunk by chunk.
+    Without a TTY every frame starts with an 8-byte header (stream id, three zero bytes,
+    big-endian payload size); with one the output is raw stdout. Frames are split
+    into lines per stream, and lines longer than MAX_LOG_LINE are cut so memory stays bounded.
+    """
+
+    def __init__(self, tty: bool = False):
+        self.tty = tty
+        self._buffer = bytearray()
+        self._partial: Dict[str, bytearray] = {}
+
+    def _lines(self, stream: str, payload: bytes) -> List[Tuple[str, bytes]]:
+        pending = self._partial.setdefault(stream, bytearray())
+        pending += payload
+        *complete, rest = pending.split(b"\n")
+        lines = [(stream, line) for line in complete]
+        while len(rest) > MAX_LOG_LINE:
+            lines.append((stream, bytes(rest[:MAX_LOG_LINE])))
+            rest = rest[MAX_LOG_LINE:]
+        self._partial[stream] = bytearray(rest)
+        return lines
 
-async def get_container_logs(container: str):
-    return await fetch(f"{env.DOCKER_URL}/containers/{container}/logs?stdout=1&stderr=1")
+    def feed(self, chunk: bytes) -> List[Tuple[str, bytes]]:
+        """The complete lines the chunk finishes, as (stream, line) pairs"""
+        if self.tty:
+            return self._lines("stdout", chunk)
+        self._buffer += chunk
+        lines: List[Tuple[str, bytes]] = []
+        while len(self._buffer) >= 8:
+            size = int.from_bytes(self._buffer[4:8], "big")
+            if len(self._buffer) < 8 + size:
+                break
+            stream = LOG_STREAMS.get(self._buffer[0], "stdout")
+            payload = bytes(self._buffer[8 : 8 + size])
+            del self._buffer[: 8 + size]
+            lines.extend(self._lines(stream, payload))
+        return lines
 
-async def get_containers() -> List[Dict[str, Any]]:
-    containers = await fetch(f"{env.DOCKER_URL}/containers/json?all=1")
+    def flush(self) -> List[Tuple[str, bytes]]:
+        """The unterminated last line of each stream"""
+        lines = [(stream, bytes(rest)) for stream, rest in self._partial.items() if rest]
+        self._partial.clear()
+        return lines
 
-    return await asyncio.gather(
-        *[get_container(container["Id"]) for container in containers]
+
+def log_event(stream: str, line: bytes, timestamps: bool = False) -> Dict[str, Any]:
+    text = line.decode(errors="replace").rstrip("\r")
+    event: Dict[str, Any] = {"type": "log", "stream": stream}
+    if timestamps:
+        time, _, text = text.partition(" ")
+        event["time"] = time
+    event["line"] = text
+    return event
+
+async def get_container_logs(
+    container: str,
+    tty: bool = False,
+    tail: Optional[int] = None,
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    follow: bool = False,
+    timestamps: bool = False,
+    stdout: bool = True,
+    stderr: bool = True,
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Stream the log lines of a container as `{"type": "log", "stream", "line"}` events,
+    demultiplexed as the chunks arrive. Only the lines after `since` / before `until`
+    (unix timestamps), or the last `tail` ones, are read; `follow` keeps streaming new output.
+    """
+    params: Dict[str, Any] = {
+        "stdout": int(stdout),
+        "stderr": int(stderr),
+        "follow": int(follow),
+        "timestamps": int(timestamps),
+        "tail": "all" if tail is None else tail,
+    }
+    if since is not None:
+        params["since"] = since
+    if until is not None:
+        params["until"] = until
+    demuxer = LogDemuxer(tty)
+    async for chunk in engine.logs(container, **params):
+        for stream, line in demuxer.feed(chunk):
+            yield log_event(stream, line, timestamps)
+    for stream, line in demuxer.flush():
+        yield log_event(stream, line, timestamps)
+
+def container_filters(
+    label: Optional[List[str]] = None,
+    status: Optional[List[str]] = None,
+    name: Optional[List[str]] = None,
+    ids: Optional[List[str]] = None,
+) -> Dict[str, List[str]]:
+    """Build the `filters` map understood by the docker list endpoint"""
+    filters = {"label": label, "status": status, "name": name, "id": ids}
+    return {key: value for key, value in filters.items() if value}
+
+async def get_containers(
+    filters: Optional[Dict[str, List[str]]] = None,
+    fields: Optional[List[str]] = None,
+    inspect: bool = False,
+    offset: int = 0,
+    limit: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """
+    Lists containers with a single call to the list endpoint.
+    Args:
+    - filters: Docker list filters (label, status, name, id), applied by the daemon
+    - fields: Inspect fields (e.g. "State", "NetworkSettings") merged into each summary
+    - inspect: Return the full inspect document instead of the summary
+    - offset, limit: Page of the listing to return
+
+    Only the containers of the requested page are inspected, and at most
+    `DOCKER_INSPECT_CONCURRENCY` inspects run at a time.
+    """
+    params: Dict[str, Any] = {"all": 1}
+    if filters:
+        params["filters"] = json.dumps(filters)
+    containers = await engine.list(params)
+    end = offset + limit if limit is not None else None
+    page = containers[offset:end]
+    if not inspect and not fields:
+        return page
+    details = await gather_limited(
+        [get_container(container["Id"]) for container in page],
+        env.DOCKER_INSPECT_CONCURRENCY,
     )
+    if inspect:
+        return details
+    return [
+        {**summary, **{field: detail.get(field) for field in fields or []}}
+        for summary, detail in zip(page, details)
+    ]
 
 async def create_container(name: str, container: ContainerConfig) -> Dict[str, Any]:
     """
@@ -77,20 +407,90 @@ async def create_container(name: str, container: ContainerConfig) -> Dict[str, A
             }
         },
     }
-    async with ClientSession() as session:
-        async with session.post(
-            f"{env.DOCKER_URL}/containers/create?name={name}", json=payload
-        ) as response:
-            image_status = await pull_image(container.image)
-            if image_status["status"] == "success":
-                id_ = (await response.json())["Id"]
-                await start_container(id_)
-                return await get_container(id_)
-            else:
-                return image_status
+    image_status = await pull_image(container.image)
+    if "error" in image_status:
+        return image_status
+    created = await engine.create(name, payload)
+    if "Id" not in created:
+        return created
+    await start_container(created["Id"])
+    return await get_container(created["Id"])
+
+async def delete_container(container: str, force: bool = False):
+    return await engine.remove(container, force=force)
+
+
+class LifecycleAction(str, Enum):
+    start = "start"
+    stop = "stop"
+    restart = "restart"
+    remove = "remove"
+
 
-async def delete_container(container: str):
-    return await fetch(f"{env.DOCKER_URL}/containers/{container}", "DELETE")
+class LifecycleRequest(BaseModel):
+    action: LifecycleAction = Field(..., example="restart")
+    ids: List[str] = Field(default_factory=list, description="Container ids or names")
+    label: Optional[List[str]] = Field(default=None, example=["app=my-app"])
+    name: Optional[List[str]] = Field(default=None)
+    timeout: Optional[int] = Field(default=None, ge=0, description="Seconds to wait before killing on stop/restart")
+    force: bool = Field(default=False, description="Remove running containers (kills them)")
+    concurrency: Optional[int] = Field(default=None, ge=1)
+
+
+def resolve_container_id(ref: str, containers: List[Dict[str, Any]]) -> Optional[str]:
+    """The full id of the container `ref` names: its full id, an id prefix, or one of its names"""
+    name = "/" + ref.lstrip("/")
+    for container in containers:
+        if container["Id"] == ref or name in (container.get("Names") or []):
+            return container["Id"]
+    prefixed = [container["Id"] for container in containers if container["Id"].startswith(ref)]
+    return prefixed[0] if len(prefixed) == 1 else None
+
+async def lifecycle_call(action: LifecycleAction, container: str, timeout: Optional[int] = None, force: bool = False) -> Dict[str, Any]:
+    """Run one lifecycle action and report its outcome (304 means it was already in that state)"""
+    params: Dict[str, Any] = {}
+    if action == LifecycleAction.remove:
+        method, path = "DELETE", f"/containers/{container}"
+        if force:
+            params["force"] = 1
+    else:
+        method, path = "POST", f"/containers/{container}/{action.value}"
+        if timeout is not None and action != LifecycleAction.start:
+            params["t"] = timeout
+    try:
+        status, body = await engine.call(method, path, params=params or None)
+    except Exception as exc:
+        return {"id": container, "action": action.value, "ok": False, "changed": False, "error": repr(exc)}
+    ok = status < 400
+    result: Dict[str, Any] = {"id": container, "action": action.value, "ok": ok, "changed": ok and status != 304}
+    if status >= 400:
+        result["error"] = body.get("message") if isinstance(body, dict) else body
+    return result
+
+async def bulk_lifecycle(request: LifecycleRequest) -> List[Dict[str, Any]]:
+    """
+    Apply a lifecycle action to the listed containers and to the ones matching the
+    label/name selectors, at most `concurrency` (DOCKER_LIFECYCLE_CONCURRENCY) at a time.
+    Listed ids (short or full) and names are resolved to full ids first, so a container
+    given several ways or also matched by a selector gets the action once.
+    :return: One result per container.
+    """
+    targets: List[str] = []
+    if request.ids:
+        containers = await engine.list({"all": 1})
+        for ref in request.ids:
+            id_ = resolve_container_id(ref, containers)
+            # unknown refs go through as given so their result carries the daemon's error
+            targets.append(id_ or ref)
+    filters = container_filters(label=request.label, name=request.name)
+    if filters:
+        matched = await engine.list({"all": 1, "filters": json.dumps(filters)})
+        targets.extend(c["Id"] for c in matched)
+    targets = list(dict.fromkeys(targets))
+    return await gather_limited(
+        [lifecycle_call(request.action, container, request.timeout, request.force) for container in targets],
+        request.concurrency or env.DOCKER_LIFECYCLE_CONCURRENCY,
+    )
 
 async def get_container_stats(container: str) -> Dict[str, Any]:
     """
@@ -107,10 +507,4 @@ async def get_container_stats(container: str) -> Dict[str, Any]:
     - Block I/O
     """
 
-    async with ClientSession() as session:
-        async with session.get(
-            f"{env.DOCKER_URL}/containers/{container}/stats?stream=0"
-        ) as response:
-            return await response.json()
-        
-        
\ No newline at end of file
+    return await engine.stats(container)
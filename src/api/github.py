@@ -0,0 +1,281 @@
+import io
+import os
+import re
+import shutil
+import asyncio
+import tarfile
+import tempfile
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+from aiohttp import ClientResponse, ClientTimeout
+from src.config import env, fetch, sessions
+from src.executor import executor
+from src.utils import get_dir_size
+
+HEADERS = {
+    "Accept": "application/vnd.github.v3+json",
+    "Authorization": f"token {env.GH_API_KEY}",
+}
+
+SHA_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+
+# large tarballs stream for minutes: no total bound, only a stalled connect or read fails
+TARBALL_TIMEOUT = ClientTimeout(total=None, sock_connect=env.HTTP_CONNECT_TIMEOUT, sock_read=env.CLONE_READ_TIMEOUT)
+
+
+async def get_latest_commit_sha(owner: str, repo: str) -> str:
+    """
+    Gets the SHA of the latest commit in the repository.
+    :return: The SHA of the latest commit.
+    """
+
+    url = f"https://api.github.com/repos/{owner}/{repo}/commits?per_page=1"
+
+    payload = await fetch(url, headers=HEADERS)
+
+    return payload[0]["sha"]
+
+
+async def resolve_commit_sha(owner: str, repo: str, ref: Optional[str] = None) -> str:
+    """
+    The full SHA of a commit, branch, tag or short SHA (the latest commit when omitted).
+    A full SHA is returned as is, anything else costs one commits API call.
+    """
+    if ref and SHA_PATTERN.match(ref):
+        return ref
+    if not ref:
+        return await get_latest_commit_sha(owner, repo)
+    payload = await fetch(f"https://api.github.com/repos/{owner}/{repo}/commits/{ref}", headers=HEADERS)
+    if not isinstance(payload, dict) or "sha" not in payload:
+        raise ValueError(f"Unknown ref {ref} of {owner}/{repo}")
+    return payload["sha"]
+
+
+class ResponseReader(io.RawIOBase):
+    """
+    Blocking file object over the body of an aiohttp response.
+    Meant to be read from a worker thread: every read pulls the next chunk
+    from the event loop, so only one network chunk is held in memory at a time.
+    """
+
+    def __init__(self, response: ClientResponse, loop: asyncio.AbstractEventLoop):
+        self._content = response.content
+        self._loop = loop
+        self._buffer = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b: Any) -> int:
+        if not self._buffer:
+            future = asyncio.run_coroutine_threadsafe(self._content.readany(), self._loop)
+            self._buffer = future.result()
+            if not self._buffer:
+                return 0
+        size = min(len(b), len(self._buffer))
+        b[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+def _inside(root: str, path: str) -> bool:
+    return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+
+def extract_stream(fileobj: Any, dest: str) -> Tuple[Optional[str], int]:
+    """
+    Extracts a gzipped tar stream into `dest` one member at a time, rejecting
+    members (or link targets) that would land outside of it.
+    :return: The commit SHA recorded by GitHub in the archive (pax comment or
+        top-level directory name) and the number of bytes written.
+    """
+    root = os.path.realpath(dest)
+    top: Optional[str] = None
+    size = 0
+    with tarfile.open(fileobj=fileobj, mode="r|gz") as tar:
+        for member in tar:
+            target = os.path.join(root, member.name)
+            if not _inside(root, target):
+                raise ValueError(f"Unsafe path in tarball: {member.name}")
+            if member.issym() and not _inside(
+                root, os.path.join(os.path.dirname(target), member.linkname)
+            ):
+                raise ValueError(f"Unsafe link in tarball: {member.name}")
+            if member.islnk() and not _inside(root, os.path.join(root, member.linkname)):
+                raise ValueError(f"Unsafe link in tarball: {member.name}")
+            if member.isdev():
+                continue
+            if top is None:
+                top = member.name.split("/")[0]
+            tar.extract(member, root)
+            size += member.size if member.isfile() else 0
+        sha = tar.pax_headers.get("comment")
+    if not sha and top:
+        sha = top.rsplit("-", 1)[-1]
+    return sha, size
+
+
+def _make_temp_dir(root: str) -> str:
+    os.makedirs(root, exist_ok=True)
+    return tempfile.mkdtemp(prefix=".clone-", dir=root)
+
+
+def _move_into_place(tmp: str, dest: str) -> None:
+    """Rename a finished extraction to its final path, unless another one got there first"""
+    if os.path.isdir(dest):
+        shutil.rmtree(tmp)
+    else:
+        os.rename(tmp, dest)
+
+
+async def clone_tarball(
+    owner: str, repo: str, root: str = "/containers", ref: Optional[str] = None
+) -> Tuple[str, str, int]:
+    """
+    Streams the tarball of a repository (latest commit unless `ref` is given) straight to disk.
+    The archive is extracted into a temporary directory while it downloads and
+    then renamed to `{root}/{sha}`, using `ref` when it's a full SHA and otherwise the
+    full SHA embedded in the archive (a ValueError is raised when there's none).
+    :return: The commit SHA, the directory it was extracted to and its size in bytes.
+    """
+    tmp = await executor.run(_make_temp_dir, root)
+    loop = asyncio.get_running_loop()
+    url = f"https://api.github.com/repos/{owner}/{repo}/tarball"
+    if ref:
+        url = f"{url}/{ref}"
+    try:
+        async with sessions.session("github").get(url, headers=HEADERS, timeout=TARBALL_TIMEOUT) as response:
+            response.raise_for_status()
+            reader = ResponseReader(response, loop)
+            sha, size = await executor.run(extract_stream, reader, tmp)
+        if not sha:
+            raise ValueError(f"Empty tarball for {owner}/{repo}")
+        if ref and SHA_PATTERN.match(ref):
+            # the top-level directory only carries a short SHA when the archive has no pax comment
+            if not ref.startswith(sha):
+                raise ValueError(f"Tarball of {owner}/{repo}@{ref} holds commit {sha}")
+            sha = ref
+        elif not SHA_PATTERN.match(sha):
+            raise ValueError(f"Tarball of {owner}/{repo} has no full commit SHA (got {sha})")
+        dest = os.path.join(root, sha)
+        await executor.run(_move_into_place, tmp, dest)
+        return sha, dest, size
+    except BaseException:
+        await executor.run(shutil.rmtree, tmp, True)
+        raise
+
+
+class CloneCache:
+    """
+    Content-addressed cache of extracted repositories, one `{root}/{sha}` directory per commit.
+    - A complete directory is reused without touching the network.
+    - Extractions land in a temp dir and are renamed into place, so partial trees are never visible.
+    - Refs are resolved to the full SHA before the lookup: a full SHA skips the network,
+      an omitted ref, branch or short SHA costs one commits API call (the price of a cache hit
+      that's still correct when the branch moves).
+    - Concurrent requests for the same SHA share one in-flight download.
+    - Least recently used trees are evicted past `max_bytes` or `max_entries`; sizes are
+      recorded once per tree and the total is kept incrementally. Trees pinned by a reader
+      (`get(pin=True)` until `release`, or `checkout`) are never evicted.
+    """
+
+    def __init__(self, root: str, max_bytes: int, max_entries: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, int]" = OrderedDict()
+        self.size = 0
+        self._inflight: Dict[str, "asyncio.Task[Tuple[str, str]]"] = {}
+        self._readers: Dict[str, int] = {}
+        self._loading: Optional["asyncio.Future[None]"] = None
+
+    def _load(self) -> None:
+        """Index trees already on disk (oldest first) and drop stale temp dirs"""
+        if not os.path.isdir(self.root):
+            return
+        trees = []
+        with os.scandir(self.root) as it:
+            for entry in it:
+                if entry.name.startswith(".clone-"):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                elif entry.is_dir() and SHA_PATTERN.match(entry.name):
+                    trees.append((entry.stat().st_mtime, entry.name, entry.path))
+        for _, sha, path in sorted(trees):
+            self._add(sha, get_dir_size(path))
+
+    def _add(self, sha: str, size: int) -> None:
+        self.entries[sha] = size
+        self.size += size
+
+    def path(self, sha: str) -> str:
+        return os.path.join(self.root, sha)
+
+    def evict(self, keep: Optional[str] = None) -> List[str]:
+        """Drop least recently used trees (except `keep` and pinned ones) until the cache is within bounds
+        :return: The directories to remove from disk.
+        """
+        evicted = []
+        for sha in [sha for sha in self.entries if sha != keep and not self._readers.get(sha)]:
+            if self.size <= self.max_bytes and len(self.entries) <= self.max_entries:
+                break
+            self.size -= self.entries.pop(sha)
+            evicted.append(self.path(sha))
+        return evicted
+
+    async def _evict(self, keep: Optional[str] = None) -> None:
+        for evicted in self.evict(keep):
+            await executor.run(shutil.rmtree, evicted, True)
+
+    async def get(
+        self, owner: str, repo: str, sha: Optional[str] = None, pin: bool = False
+    ) -> Tuple[str, str]:
+        """
+        Returns the full SHA and local directory of a commit, downloading it on a miss.
+        :param sha: The commit, branch, tag or short SHA to fetch, the latest commit when omitted.
+        :param pin: Keep the tree from being evicted until `release(sha)` is awaited.
+        """
+        if self._loading is None:
+            self._loading = asyncio.ensure_future(executor.run(self._load))
+        await self._loading
+        sha = await resolve_commit_sha(owner, repo, sha)
+        # loops only when another download evicted the tree before this one resumed
+        while sha not in self.entries:
+            task = self._inflight.get(sha)
+            if task is None:
+                task = self._inflight[sha] = asyncio.create_task(self._download(owner, repo, sha))
+                task.add_done_callback(lambda _: self._inflight.pop(sha, None))
+            await asyncio.shield(task)
+        self.entries.move_to_end(sha)
+        if pin:
+            self._readers[sha] = self._readers.get(sha, 0) + 1
+        return sha, self.path(sha)
+
+    async def release(self, sha: str) -> None:
+        """Unpin a tree from `get(pin=True)`, evicting what its pin held back"""
+        readers = self._readers.get(sha, 0) - 1
+        if readers > 0:
+            self._readers[sha] = readers
+            return
+        self._readers.pop(sha, None)
+        await self._evict()
+
+    @asynccontextmanager
+    async def checkout(self, owner: str, repo: str, sha: Optional[str] = None) -> AsyncIterator[Tuple[str, str]]:
+        """`get` a commit, pinned for the duration of the block"""
+        sha, path = await self.get(owner, repo, sha, pin=True)
+        try:
+            yield sha, path
+        finally:
+            await self.release(sha)
+
+    async def _download(self, owner: str, repo: str, sha: str) -> Tuple[str, str]:
+        sha, path, size = await clone_tarball(owner, repo, self.root, ref=sha)
+        if sha not in self.entries:
+            self._add(sha, size)
+        self.entries.move_to_end(sha)
+        await self._evict(keep=sha)
+        return sha, path
+
+
+clones = CloneCache(env.CLONE_ROOT, env.CLONE_CACHE_MAX_BYTES, env.CLONE_CACHE_MAX_ENTRIES)
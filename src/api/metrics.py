@@ -0,0 +1,248 @@
+"""Container resource metrics sampled from the docker stats streams into fixed-size ring buffers"""
+import json
+import math
+import time
+import asyncio
+from array import array
+from typing import Any, Dict, List, Optional
+from src.config import env
+from src.api.docker import DockerEngine
+from src.api.state import container_index
+
+FIELDS = (
+    "cpu_percent",
+    "memory_usage",
+    "memory_limit",
+    "memory_percent",
+    "net_rx_rate",
+    "net_tx_rate",
+    "blk_read_rate",
+    "blk_write_rate",
+    "pids",
+)
+
+# stats streams hold a connection each, keep them off the pool the API calls use
+stats_engine = DockerEngine(upstream="docker-stats")
+
+
+class RingBuffer:
+    """
+    The last `size` samples of a container: one preallocated array of doubles per
+    field plus one of timestamps, overwritten in place once full.
+    """
+
+    def __init__(self, size: int, fields=FIELDS):
+        self.size = size
+        self.times = array("d", bytes(8 * size))
+        self.columns = {field: array("d", bytes(8 * size)) for field in fields}
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp: float, sample: Dict[str, float]) -> None:
+        i = self.head
+        self.times[i] = timestamp
+        for field, column in self.columns.items():
+            column[i] = sample.get(field, 0.0)
+        self.head = (i + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def _positions(self, since: Optional[float] = None) -> List[int]:
+        """Slots of the samples taken at or after `since`, newest first"""
+        positions = []
+        for n in range(1, self.count + 1):
+            i = (self.head - n) % self.size
+            if since is not None and self.times[i] < since:
+                break
+            positions.append(i)
+        return positions
+
+    def latest(self) -> Optional[Dict[str, float]]:
+        if not self.count:
+            return None
+        i = (self.head - 1) % self.size
+        return {"time": self.times[i], **{field: column[i] for field, column in self.columns.items()}}
+
+    def window(self, seconds: float) -> Dict[str, Any]:
+        """min/avg/max/p95 of each field over the last `seconds`"""
+        positions = self._positions(time.time() - seconds)
+        stats: Dict[str, Any] = {"samples": len(positions)}
+        if not positions:
+            return stats
+        for field, column in self.columns.items():
+            values = sorted(column[i] for i in positions)
+            stats[field] = {
+                "min": values[0],
+                "avg": sum(values) / len(values),
+                "max": values[-1],
+                "p95": values[max(math.ceil(0.95 * len(values)) - 1, 0)],
+            }
+        return stats
+
+
+def _io_totals(raw: Dict[str, Any]) -> Dict[str, float]:
+    networks = raw.get("networks") or {}
+    blkio = (raw.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []
+    return {
+        "rx": float(sum(n.get("rx_bytes", 0) for n in networks.values())),
+        "tx": float(sum(n.get("tx_bytes", 0) for n in networks.values())),
+        "read": float(sum(e.get("value", 0) for e in blkio if e.get("op", "").lower() == "read")),
+        "write": float(sum(e.get("value", 0) for e in blkio if e.get("op", "").lower() == "write")),
+    }
+
+
+def compute_sample(
+    raw: Dict[str, Any], previous: Optional[Dict[str, float]] = None, elapsed: float = 0.0
+) -> Dict[str, float]:
+    """
+    Turn a docker stats message into a sample: CPU % of the host (like `docker stats`),
+    memory without the page cache, and network / block I/O rates in bytes per second
+    against the `previous` I/O totals taken `elapsed` seconds earlier.
+    """
+    cpu = raw.get("cpu_stats") or {}
+    precpu = raw.get("precpu_stats") or {}
+    cpu_delta = (cpu.get("cpu_usage") or {}).get("total_usage", 0) - (precpu.get("cpu_usage") or {}).get(
+        "total_usage", 0
+    )
+    system_delta = cpu.get("system_cpu_usage", 0) - precpu.get("system_cpu_usage", 0)
+    online = cpu.get("online_cpus") or len((cpu.get("cpu_usage") or {}).get("percpu_usage") or []) or 1
+    cpu_percent = cpu_delta / system_delta * online * 100.0 if system_delta > 0 and cpu_delta > 0 else 0.0
+
+    memory = raw.get("memory_stats") or {}
+    details = memory.get("stats") or {}
+    # cgroup v1 reports the page cache as "cache", v2 as "inactive_file"
+    cache = details.get("cache", details.get("inactive_file", 0))
+    usage = max(memory.get("usage", 0) - cache, 0)
+    limit = memory.get("limit", 0)
+
+    sample = {
+        "cpu_percent": cpu_percent,
+        "memory_usage": float(usage),
+        "memory_limit": float(limit),
+        "memory_percent": usage / limit * 100.0 if limit else 0.0,
+        "pids": float((raw.get("pids_stats") or {}).get("current", 0)),
+    }
+    totals = _io_totals(raw)
+    if previous is not None and elapsed > 0:
+        for field, key in (
+            ("net_rx_rate", "rx"),
+            ("net_tx_rate", "tx"),
+            ("blk_read_rate", "read"),
+            ("blk_write_rate", "write"),
+        ):
+            sample[field] = max(totals[key] - previous[key], 0.0) / elapsed
+    return sample
+
+
+class StatsSampler:
+    """
+    Follows the `stats?stream=1` stream of every running container and keeps a ring
+    buffer of `history` samples each, so stats reads are memory lookups.
+    Running containers are reconciled every `interval` seconds (from the container
+    index when it's synced): new ones get a stream and the streams of stopped ones
+    are cancelled (the daemon keeps them open, sending empty samples).
+    """
+
+    def __init__(self, history: int, interval: float, engine: Optional[DockerEngine] = None):
+        self.history = history
+        self.interval = interval
+        self.engine = engine or stats_engine
+        self.buffers: Dict[str, RingBuffer] = {}
+        self.names: Dict[str, str] = {}
+        self._streams: Dict[str, "asyncio.Task[None]"] = {}
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        tasks = list(self._streams.values())
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._streams.clear()
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"Stats sampler reconcile failed: {exc!r}")
+            await asyncio.sleep(self.interval)
+
+    async def _running(self) -> List[Dict[str, Any]]:
+        if container_index.synced:
+            return [c for c in container_index.summaries.values() if c.get("State") == "running"]
+        return await self.engine.list({"filters": json.dumps({"status": ["running"]})})
+
+    async def reconcile(self) -> None:
+        running = {c["Id"]: c for c in await self._running()}
+        for id_, summary in running.items():
+            self.names[id_] = ((summary.get("Names") or [id_])[0]).lstrip("/")
+            if id_ not in self.buffers:
+                self.buffers[id_] = RingBuffer(self.history)
+            if id_ not in self._streams:
+                self._streams[id_] = asyncio.create_task(self._follow(id_, self.buffers[id_]))
+        stopped = [id_ for id_ in self._streams if id_ not in running]
+        tasks = [self._streams.pop(id_) for id_ in stopped]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for id_ in list(self.buffers):
+            if id_ not in running:
+                self.buffers.pop(id_, None)
+                self.names.pop(id_, None)
+
+    async def _follow(self, container: str, buffer: RingBuffer) -> None:
+        previous: Optional[Dict[str, float]] = None
+        last = 0.0
+        try:
+            async for raw in self.engine.stream_stats(container):
+                if "error" in raw:
+                    break
+                now = time.time()
+                buffer.append(now, compute_sample(raw, previous, now - last))
+                previous, last = _io_totals(raw), now
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            print(f"Stats stream of {container[:12]} ended: {exc!r}")
+        finally:
+            if self._streams.get(container) is asyncio.current_task():
+                del self._streams[container]
+
+    def resolve(self, container: str) -> Optional[str]:
+        if container in self.buffers:
+            return container
+        for id_, name in self.names.items():
+            if name == container.lstrip("/") or id_.startswith(container):
+                return id_
+        return None
+
+    def summary(self, container: str, window: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """Latest sample of a container, plus the aggregates over `window` seconds when given"""
+        id_ = self.resolve(container)
+        buffer = self.buffers.get(id_) if id_ is not None else None
+        if buffer is None:
+            return None
+        result: Dict[str, Any] = {
+            "id": id_,
+            "name": self.names.get(id_),
+            "streaming": id_ in self._streams,
+            "latest": buffer.latest(),
+        }
+        if window is not None:
+            result["window"] = buffer.window(window)
+        return result
+
+    def all(self, window: Optional[float] = None) -> List[Dict[str, Any]]:
+        summaries = [self.summary(id_, window) for id_ in list(self.buffers)]
+        return [summary for summary in summaries if summary is not None]
+
+
+stats_sampler = StatsSampler(env.STATS_HISTORY, env.STATS_SYNC_INTERVAL)
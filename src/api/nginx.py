@@ -0,0 +1,232 @@
+"""nginx routes for deployed apps: one server block per app, written atomically and reloaded in batches"""
+import os
+import re
+import asyncio
+import hashlib
+import tempfile
+from typing import Any, Dict, List, Optional
+from jinja2 import Template
+from src.config import env
+from src.constants import NGINX_CONFIG
+from src.executor import executor
+
+# label set on the containers of deployed apps, holding the app (route) name
+APP_LABEL = "cubecloud.app"
+PORT_PATTERN = re.compile(r"proxy_pass http://localhost:(\d+);")
+
+
+def _digest(content: str) -> str:
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def write_if_changed(path: str, content: str) -> bool:
+    """Atomically replace a file unless it already holds `content`"""
+    try:
+        with open(path) as f:
+            if _digest(f.read()) == _digest(content):
+                return False
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", suffix=".conf", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return True
+
+
+def read_file(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def remove_file(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class NginxRoutes:
+    """
+    In-memory table of app name -> upstream host port, mirrored to `{name}.conf` in every config dir.
+    - The server block template is compiled once.
+    - Files are only rewritten when their content changes, through a temp file and rename.
+    - Route changes within `debounce` seconds share one `nginx -t` + `nginx -s reload`.
+    - When `nginx -t` rejects them, the files and routes they touched are put back as they were.
+    - `load` fills the table back from the files on disk after a restart.
+    """
+
+    def __init__(self, dirs: List[str], binary: str = "nginx", debounce: float = 0.5):
+        self.dirs = dirs
+        self.binary = binary
+        self.debounce = debounce
+        self.template = Template(NGINX_CONFIG)
+        self.routes: Dict[str, int] = {}
+        self._hashes: Dict[str, str] = {}
+        self._reload: Optional["asyncio.Future[Dict[str, Any]]"] = None
+        # state before the changes of the pending reload: file contents (None: absent) and ports
+        self._files: Dict[str, Optional[str]] = {}
+        self._ports: Dict[str, Optional[int]] = {}
+
+    def render(self, name: str, port: int) -> str:
+        return self.template.render(id=name, port=port)
+
+    def _backup(self, path: str) -> None:
+        if path not in self._files:
+            self._files[path] = read_file(path)
+
+    def _write(self, name: str, config: str) -> bool:
+        changed = False
+        for directory in self.dirs:
+            path = os.path.join(directory, f"{name}.conf")
+            digest = _digest(config)
+            if self._hashes.get(path) == digest:
+                continue
+            self._backup(path)
+            changed = write_if_changed(path, config) or changed
+            self._hashes[path] = digest
+        return changed
+
+    def _remove(self, name: str) -> bool:
+        changed = False
+        for directory in self.dirs:
+            path = os.path.join(directory, f"{name}.conf")
+            self._hashes.pop(path, None)
+            self._backup(path)
+            changed = remove_file(path) or changed
+        return changed
+
+    def _restore(self, files: Dict[str, Optional[str]]) -> None:
+        for path, content in files.items():
+            self._hashes.pop(path, None)
+            if content is None:
+                remove_file(path)
+            else:
+                write_if_changed(path, content)
+
+    def _scan(self) -> Dict[str, int]:
+        """Routes of the `{name}.conf` files we rendered (other configs in the dirs are left alone)"""
+        found: Dict[str, int] = {}
+        for directory in self.dirs:
+            try:
+                entries = os.listdir(directory)
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                if not entry.endswith(".conf") or entry.startswith(".tmp-"):
+                    continue
+                path = os.path.join(directory, entry)
+                content = read_file(path)
+                match = PORT_PATTERN.search(content or "")
+                name = entry[:-len(".conf")]
+                if match is None or content != self.render(name, int(match.group(1))):
+                    continue
+                found.setdefault(name, int(match.group(1)))
+                self._hashes[path] = _digest(content)
+        return found
+
+    async def load(self) -> Dict[str, int]:
+        """Add the routes found on disk to the table, keeping the ones already set"""
+        found = await executor.run(self._scan)
+        for name, port in found.items():
+            self.routes.setdefault(name, port)
+        return found
+
+    def _remember(self, name: str) -> None:
+        if name not in self._ports:
+            self._ports[name] = self.routes.get(name)
+
+    async def set(self, name: str, port: int) -> bool:
+        """Route `name` to a host port, scheduling a reload when a file changed"""
+        self._remember(name)
+        self.routes[name] = int(port)
+        changed = await executor.run(self._write, name, self.render(name, port))
+        if changed:
+            self.schedule_reload()
+        return changed
+
+    async def remove(self, name: str) -> bool:
+        """Drop the route of `name`, scheduling a reload when a file was removed"""
+        self._remember(name)
+        self.routes.pop(name, None)
+        changed = await executor.run(self._remove, name)
+        if changed:
+            self.schedule_reload()
+        return changed
+
+    async def apply(self, name: str, port: int) -> Dict[str, Any]:
+        """Route `name` to a host port and wait until nginx serves it"""
+        if await self.set(name, port):
+            return await self.schedule_reload()
+        return {"reloaded": False, "changed": False}
+
+    def schedule_reload(self) -> "asyncio.Future[Dict[str, Any]]":
+        """Reload nginx after the debounce window, joining a reload that hasn't started yet"""
+        if self._reload is None:
+            self._reload = asyncio.get_running_loop().create_future()
+            asyncio.create_task(self._flush(self._reload))
+        return self._reload
+
+    async def _flush(self, future: "asyncio.Future[Dict[str, Any]]") -> None:
+        await asyncio.sleep(self.debounce)
+        # changes from here on go to the next reload
+        self._reload = None
+        files, self._files = self._files, {}
+        ports, self._ports = self._ports, {}
+        try:
+            code, out, err = await executor.subprocess(self.binary, "-t")
+            if code != 0:
+                # put the last valid config back so later reloads aren't blocked by this one
+                await executor.run(self._restore, files)
+                for name, port in ports.items():
+                    if port is None:
+                        self.routes.pop(name, None)
+                    else:
+                        self.routes[name] = port
+                result = {"reloaded": False, "changed": True, "restored": True, "error": err or out}
+            else:
+                code, out, err = await executor.subprocess(self.binary, "-s", "reload")
+                result = {"reloaded": code == 0, "changed": True}
+                if code != 0:
+                    result["error"] = err or out
+        except Exception as exc:
+            result = {"reloaded": False, "changed": True, "error": repr(exc)}
+        future.set_result(result)
+
+    async def sync(self, containers: List[Dict[str, Any]], prune: bool = True) -> Dict[str, Any]:
+        """
+        Make the routes match a list of running containers (list endpoint summaries),
+        routing each deployed app (containers labelled APP_LABEL) to its first published port.
+        """
+        wanted: Dict[str, int] = {}
+        for container in containers:
+            name = (container.get("Labels") or {}).get(APP_LABEL)
+            ports = [p["PublicPort"] for p in container.get("Ports") or [] if p.get("PublicPort")]
+            if name and ports:
+                wanted[name] = ports[0]
+        changed = False
+        for name, port in wanted.items():
+            self._remember(name)
+            self.routes[name] = port
+            changed = await executor.run(self._write, name, self.render(name, port)) or changed
+        removed = [name for name in list(self.routes) if name not in wanted] if prune else []
+        for name in removed:
+            self._remember(name)
+            self.routes.pop(name, None)
+            changed = await executor.run(self._remove, name) or changed
+        result = await self.schedule_reload() if changed else {"reloaded": False, "changed": False}
+        return {**result, "routes": wanted, "removed": removed}
+
+
+routes = NginxRoutes(env.NGINX_DIRS, env.NGINX_BIN, env.NGINX_RELOAD_DEBOUNCE)
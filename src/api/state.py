@@ -0,0 +1,183 @@
+"""In-process container state index kept up to date by the docker /events stream"""
+import re
+import json
+import time
+import asyncio
+from typing import Any, Dict, List, Optional
+from src.config import env
+from src.api.docker import DockerEngine, engine as docker_engine
+from src.utils import gather_limited
+
+# container actions after which the cached state is refreshed from the daemon
+REFRESH_ACTIONS = {
+    "create", "start", "restart", "die", "stop", "kill", "pause", "unpause",
+    "rename", "update", "oom",
+}
+
+
+class ContainerIndex:
+    """
+    Container summaries and inspect documents keyed by id and by name.
+    A background task does a full sync, then follows the /events stream and
+    refreshes or drops single containers on create/start/die/destroy events.
+    Reads are only served from memory once `synced` is set.
+    """
+
+    def __init__(self, engine: Optional[DockerEngine] = None, backoff: float = 1.0):
+        self.engine = engine or docker_engine
+        self.backoff = backoff
+        self.summaries: Dict[str, Dict[str, Any]] = {}
+        self.details: Dict[str, Dict[str, Any]] = {}
+        self.names: Dict[str, str] = {}
+        self.synced = False
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.synced = False
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                # replay whatever happens while the full sync is running
+                since = int(time.time())
+                await self.sync()
+                filters = json.dumps({"type": ["container"]})
+                async for event in self.engine.events(since=since, filters=filters):
+                    await self.apply(event)
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                print(f"Container index out of sync: {exc!r}")
+            self.synced = False
+            await asyncio.sleep(self.backoff)
+
+    async def sync(self) -> None:
+        """Reload every container from the daemon"""
+        summaries = await self.engine.list({"all": 1})
+        details = await gather_limited(
+            [self.engine.inspect(c["Id"]) for c in summaries], env.DOCKER_INSPECT_CONCURRENCY
+        )
+        self.summaries.clear()
+        self.details.clear()
+        self.names.clear()
+        for summary, detail in zip(summaries, details):
+            # removed between the list and the inspect
+            if "Id" not in detail:
+                continue
+            self._put(summary, detail)
+        self.synced = True
+
+    async def refresh(self, container: str) -> None:
+        """Reload a single container, dropping it when it's gone"""
+        summaries = await self.engine.list(
+            {"all": 1, "filters": json.dumps({"id": [container]})}
+        )
+        if not summaries:
+            self.drop(container)
+            return
+        detail = await self.engine.inspect(container)
+        if "Id" not in detail:
+            self.drop(container)
+            return
+        self.drop(container)
+        self._put(summaries[0], detail)
+
+    async def apply(self, event: Dict[str, Any]) -> None:
+        """Apply a docker event to the index"""
+        if event.get("Type", "container") != "container":
+            return
+        container = event.get("Actor", {}).get("ID") or event.get("id")
+        action = event.get("Action") or event.get("status") or ""
+        if not container:
+            return
+        if action == "destroy":
+            self.drop(container)
+        elif action.split(":")[0] in REFRESH_ACTIONS:
+            await self.refresh(container)
+
+    def _put(self, summary: Dict[str, Any], detail: Dict[str, Any]) -> None:
+        id_ = summary["Id"]
+        self.summaries[id_] = summary
+        self.details[id_] = detail
+        for name in summary.get("Names") or []:
+            self.names[name.lstrip("/")] = id_
+
+    def drop(self, container: str) -> None:
+        id_ = self.resolve(container) or container
+        self.summaries.pop(id_, None)
+        self.details.pop(id_, None)
+        for name in [name for name, value in self.names.items() if value == id_]:
+            del self.names[name]
+
+    def resolve(self, container: str) -> Optional[str]:
+        """Full id for an id, id prefix or name"""
+        if container in self.summaries:
+            return container
+        name = container.lstrip("/")
+        if name in self.names:
+            return self.names[name]
+        matches = [id_ for id_ in self.summaries if id_.startswith(container)]
+        return matches[0] if len(matches) == 1 else None
+
+    def get(self, container: str) -> Optional[Dict[str, Any]]:
+        """Cached inspect document for an id, id prefix or name"""
+        id_ = self.resolve(container)
+        return self.details.get(id_) if id_ else None
+
+    def list(
+        self,
+        filters: Optional[Dict[str, List[str]]] = None,
+        fields: Optional[List[str]] = None,
+        inspect: bool = False,
+        offset: int = 0,
+        limit: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
+        """Same listing as `src.api.docker.get_containers`, served from memory"""
+        summaries = sorted(
+            (s for s in self.summaries.values() if matches(s, filters or {})),
+            key=lambda s: s.get("Created", 0),
+            reverse=True,
+        )
+        end = offset + limit if limit is not None else None
+        page = summaries[offset:end]
+        if inspect:
+            return [self.details[s["Id"]] for s in page]
+        if fields:
+            return [
+                {**s, **{field: self.details[s["Id"]].get(field) for field in fields}}
+                for s in page
+            ]
+        return page
+
+
+def matches(summary: Dict[str, Any], filters: Dict[str, List[str]]) -> bool:
+    """Evaluate docker list filters against a container summary"""
+    labels = summary.get("Labels") or {}
+    for label in filters.get("label", []):
+        key, _, value = label.partition("=")
+        if key not in labels or (value and labels[key] != value):
+            return False
+    if filters.get("status") and summary.get("State") not in filters["status"]:
+        return False
+    names = [name.lstrip("/") for name in summary.get("Names") or []]
+    if filters.get("name") and not any(
+        re.search(pattern, name) for pattern in filters["name"] for name in names
+    ):
+        return False
+    if filters.get("id") and not any(summary["Id"].startswith(i) for i in filters["id"]):
+        return False
+    return True
+
+
+container_index = ContainerIndex()
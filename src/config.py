@@ -1,36 +1,161 @@
 from pydantic import BaseSettings, Field, BaseConfig
 import aiohttp
-from typing import Dict, Optional, Any
+from yarl import URL
+from typing import Dict, List, Mapping, Optional, Any, Tuple
 
-async def fetch(    
+async def fetch_response(
     url: str,
     method: str = "GET",
     headers: Optional[Dict[str, str]] = None,
-    body: Optional[bytes] = None,
+    body: Optional[Any] = None,
+    json: Optional[Dict[str, Any]] = None,
+) -> Tuple[int, Mapping[str, str], Any]:
+    """Like `fetch`, but also returns the status code and response headers"""
+    session = sessions.for_url(url)
+    async with session.request(
+        method=method, url=url, headers=headers, data=body,
+        json=json
+    ) as response:
+        if response.content_type.endswith("json"):
+            payload = await response.json()
+        elif response.content_type.startswith("text/"):
+            payload = await response.text()
+        else:
+            payload = await response.read()
+        return response.status, response.headers, payload
+
+async def fetch(
+    url: str,
+    method: str = "GET",
+    headers: Optional[Dict[str, str]] = None,
+    body: Optional[Any] = None,
     json: Optional[Dict[str, Any]] = None,
 ) -> Any:
-    async with aiohttp.ClientSession() as session:
-        async with session.request(
-            method=method, url=url, headers=headers, data=body,
-            json=json
-        ) as response:
-            if response.content_type.endswith("json"):
-                return await response.json()
-            if response.content_type.startswith("text/"):
-                return await response.text()
-            return await response.read()    
+    _, _, payload = await fetch_response(url, method, headers, body, json)
+    return payload
 
 class Settings(BaseSettings):
     CF_API_KEY: str = Field(..., env="CF_API_KEY")
     CF_EMAIL: str = Field(..., env="CF_EMAIL")
     CF_ZONE_ID: str = Field(..., env="CF_ZONE_ID")
     GH_API_KEY: str = Field(..., env="GH_API_KEY")
+    FAUNA_SECRET: Optional[str] = Field(default=None, env="FAUNA_SECRET")
     DOCKER_URL: str = Field(..., env="DOCKER_URL")
     DOCKER_IP: str = Field(..., env="DOCKER_IP")
-    
+    HTTP_KEEPALIVE: float = Field(default=30.0, env="HTTP_KEEPALIVE")
+    HTTP_LIMIT: int = Field(default=100, env="HTTP_LIMIT")
+    HTTP_LIMIT_PER_HOST: int = Field(default=32, env="HTTP_LIMIT_PER_HOST")
+    HTTP_CONNECT_TIMEOUT: float = Field(default=10.0, env="HTTP_CONNECT_TIMEOUT")
+    HTTP_TIMEOUT: float = Field(default=60.0, env="HTTP_TIMEOUT")
+    DOCKER_TIMEOUT: Optional[float] = Field(default=None, env="DOCKER_TIMEOUT")
+    DOCKER_INSPECT_CONCURRENCY: int = Field(default=8, env="DOCKER_INSPECT_CONCURRENCY")
+    DOCKER_LIFECYCLE_CONCURRENCY: int = Field(default=8, env="DOCKER_LIFECYCLE_CONCURRENCY")
+    CONTAINER_CACHE: bool = Field(default=True, env="CONTAINER_CACHE")
+    BUILD_CONTEXT_COMPRESSION: Optional[int] = Field(default=None, env="BUILD_CONTEXT_COMPRESSION")
+    CF_API_URL: str = Field(default="https://api.cloudflare.com/client/v4", env="CF_API_URL")
+    CF_RATE_LIMIT: int = Field(default=1200, env="CF_RATE_LIMIT")
+    CF_RATE_PERIOD: float = Field(default=300.0, env="CF_RATE_PERIOD")
+    CF_RETRIES: int = Field(default=4, env="CF_RETRIES")
+    CF_BATCH_CONCURRENCY: int = Field(default=8, env="CF_BATCH_CONCURRENCY")
+    DNS_CACHE_TTL: float = Field(default=300.0, env="DNS_CACHE_TTL")
+    WORKER_MULTIPART_THRESHOLD: int = Field(default=256 * 1024, env="WORKER_MULTIPART_THRESHOLD")
+    NGINX_BIN: str = Field(default="nginx", env="NGINX_BIN")
+    NGINX_DIRS: List[str] = Field(
+        default=["/etc/nginx/conf.d", "/etc/nginx/sites-enabled", "/etc/nginx/sites-available"],
+        env="NGINX_DIRS",
+    )
+    NGINX_RELOAD_DEBOUNCE: float = Field(default=0.5, env="NGINX_RELOAD_DEBOUNCE")
+    NGINX_SYNC_ON_STARTUP: bool = Field(default=True, env="NGINX_SYNC_ON_STARTUP")
+    EXECUTOR_WORKERS: int = Field(default=8, env="EXECUTOR_WORKERS")
+    BUILD_CONCURRENCY: int = Field(default=2, env="BUILD_CONCURRENCY")
+    JOB_HISTORY: int = Field(default=200, env="JOB_HISTORY")
+    CLONE_ROOT: str = Field(default="/containers", env="CLONE_ROOT")
+    CLONE_CACHE_MAX_BYTES: int = Field(default=5 * 1024 ** 3, env="CLONE_CACHE_MAX_BYTES")
+    CLONE_CACHE_MAX_ENTRIES: int = Field(default=50, env="CLONE_CACHE_MAX_ENTRIES")
+    CLONE_READ_TIMEOUT: float = Field(default=60.0, env="CLONE_READ_TIMEOUT")
+    FAUNA_CACHE_SIZE: int = Field(default=1024, env="FAUNA_CACHE_SIZE")
+    FAUNA_CACHE_TTL: float = Field(default=60.0, env="FAUNA_CACHE_TTL")
+    FAUNA_CACHE_NEGATIVE_TTL: float = Field(default=10.0, env="FAUNA_CACHE_NEGATIVE_TTL")
+    FAUNA_PROVISION: bool = Field(default=True, env="FAUNA_PROVISION")
+    FAUNA_PROVISION_DRY_RUN: bool = Field(default=False, env="FAUNA_PROVISION_DRY_RUN")
+    FAUNA_PROVISION_TIMEOUT: float = Field(default=60.0, env="FAUNA_PROVISION_TIMEOUT")
+    STATS_SAMPLER: bool = Field(default=True, env="STATS_SAMPLER")
+    STATS_HISTORY: int = Field(default=600, env="STATS_HISTORY")
+    STATS_SYNC_INTERVAL: float = Field(default=5.0, env="STATS_SYNC_INTERVAL")
+
     class Config(BaseConfig):
         env_file = ".env"
         env_file_encoding = "utf-8"
 
 env:Any = Settings()
 
+
+# base url used for requests that go through the docker unix socket connector
+DOCKER_SOCKET_URL = "http://docker"
+
+UPSTREAMS = {
+    "api.cloudflare.com": "cloudflare",
+    "api.github.com": "github",
+}
+
+
+class SessionManager:
+    """App-lifetime aiohttp sessions, one connection pool per upstream
+    (docker daemon, cloudflare, github and a default pool for anything else).
+    Pools named "docker-*" are extra pools to the daemon, e.g. for long-lived streams.
+    """
+    def __init__(self):
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+
+    def upstream(self, url: str) -> str:
+        """Name of the pool that serves the given url"""
+        if url.startswith(env.DOCKER_URL) or url.startswith(DOCKER_SOCKET_URL):
+            return "docker"
+        return UPSTREAMS.get(URL(url).host or "", "default")
+
+    def _create(self, upstream: str) -> aiohttp.ClientSession:
+        connector: aiohttp.BaseConnector
+        # each long-lived stream holds a connection, so stream pools are not capped
+        streams = upstream.startswith("docker-")
+        if upstream.startswith("docker") and env.DOCKER_URL.startswith("unix://"):
+            connector = aiohttp.UnixConnector(
+                path=env.DOCKER_URL[len("unix://"):],
+                limit=0 if streams else env.HTTP_LIMIT,
+                keepalive_timeout=env.HTTP_KEEPALIVE,
+            )
+        else:
+            connector = aiohttp.TCPConnector(
+                limit=0 if streams else env.HTTP_LIMIT,
+                limit_per_host=0 if streams else env.HTTP_LIMIT_PER_HOST,
+                keepalive_timeout=env.HTTP_KEEPALIVE,
+                ttl_dns_cache=300,
+            )
+        # docker builds and streams can run for minutes, only bound the connect
+        total = env.DOCKER_TIMEOUT if upstream.startswith("docker") else env.HTTP_TIMEOUT
+        timeout = aiohttp.ClientTimeout(total=total, sock_connect=env.HTTP_CONNECT_TIMEOUT)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    def session(self, upstream: str) -> aiohttp.ClientSession:
+        """Return the pooled session for an upstream, opening it on first use"""
+        session = self._sessions.get(upstream)
+        if session is None or session.closed:
+            session = self._sessions[upstream] = self._create(upstream)
+        return session
+
+    def for_url(self, url: str) -> aiohttp.ClientSession:
+        """Return the pooled session for the upstream serving the url"""
+        return self.session(self.upstream(url))
+
+    async def startup(self) -> None:
+        """Open every pool"""
+        for upstream in ("docker", "cloudflare", "github", "default"):
+            self.session(upstream)
+
+    async def shutdown(self) -> None:
+        """Close every pool"""
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+
+sessions = SessionManager()
@@ -0,0 +1,116 @@
+"""Docker build contexts packed as a single streamed tar"""
+import os
+import gzip
+import asyncio
+import tarfile
+import io
+from typing import Any, AsyncIterator, Callable, Optional
+from yarl import URL
+from src.config import env
+from src.executor import executor
+
+CHUNK_SIZE = 1 << 16
+
+
+class ContextClosed(Exception):
+    """The consumer of a build context stopped reading"""
+
+
+def compression_level() -> int:
+    """
+    Gzip level for build contexts: `BUILD_CONTEXT_COMPRESSION` when set,
+    otherwise off for a local daemon (unix socket or loopback) and 6 for a remote one.
+    """
+    if env.BUILD_CONTEXT_COMPRESSION is not None:
+        return env.BUILD_CONTEXT_COMPRESSION
+    if env.DOCKER_URL.startswith("unix://"):
+        return 0
+    if URL(env.DOCKER_URL).host in ("localhost", "127.0.0.1", "::1"):
+        return 0
+    return 6
+
+
+class QueueWriter(io.RawIOBase):
+    """
+    Write-only file object used from a worker thread that hands chunks of
+    at least CHUNK_SIZE bytes to an asyncio queue, blocking while the queue is full.
+    """
+
+    def __init__(self, queue: "asyncio.Queue[Optional[bytes]]", loop: asyncio.AbstractEventLoop):
+        self._queue = queue
+        self._loop = loop
+        self._buffer = bytearray()
+        self.cancelled = False
+
+    def writable(self) -> bool:
+        return True
+
+    def _put(self, chunk: Optional[bytes]) -> None:
+        if self.cancelled:
+            raise ContextClosed()
+        asyncio.run_coroutine_threadsafe(self._queue.put(chunk), self._loop).result()
+
+    def write(self, b: Any) -> int:
+        self._buffer += b
+        if len(self._buffer) >= CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(b)
+
+    def finish(self) -> None:
+        if self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+
+
+async def pack(write: Callable[[tarfile.TarFile], None], compresslevel: Optional[int] = None) -> AsyncIterator[bytes]:
+    """
+    Runs `write` against a streaming tar on a worker thread and yields the
+    (optionally gzipped) archive as it's produced, holding at most a few chunks in memory.
+    """
+    level = compression_level() if compresslevel is None else compresslevel
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[Optional[bytes]]" = asyncio.Queue(maxsize=4)
+    sink = QueueWriter(queue, loop)
+
+    def run() -> None:
+        try:
+            if level:
+                with gzip.GzipFile(fileobj=sink, mode="wb", compresslevel=level, mtime=0) as gz:
+                    with tarfile.open(fileobj=gz, mode="w|") as tar:
+                        write(tar)
+            else:
+                with tarfile.open(fileobj=sink, mode="w|") as tar:
+                    write(tar)
+            sink.finish()
+        finally:
+            if not sink.cancelled:
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+
+    future = asyncio.ensure_future(executor.run(run))
+    try:
+        while True:
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        await future
+    finally:
+        if not future.done():
+            # consumer went away, unblock the writer so the thread can exit
+            sink.cancelled = True
+            while not future.done():
+                while not queue.empty():
+                    queue.get_nowait()
+                await asyncio.sleep(0.01)
+            future.exception()
+
+
+def pack_directory(path: str, compresslevel: Optional[int] = None) -> AsyncIterator[bytes]:
+    """Stream the contents of a directory on disk as one tar"""
+
+    def write(tar: tarfile.TarFile) -> None:
+        for name in sorted(os.listdir(path)):
+            tar.add(os.path.join(path, name), arcname=name)
+
+    return pack(write, compresslevel)
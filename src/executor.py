@@ -0,0 +1,111 @@
+"""Thread pool for blocking disk and subprocess work, so it never stalls the event loop"""
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional, Tuple, TypeVar
+from src.config import env
+
+T = TypeVar("T")
+
+_DONE = object()
+
+
+class BlockingExecutor:
+    """
+    Bounded thread pool with metrics: queue depth (submitted but not started),
+    calls in flight, and cumulative time spent waiting for a worker and running.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.max_queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.run_time = 0.0
+        self.subprocesses = 0
+        self.subprocess_time = 0.0
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="blocking")
+        return self._pool
+
+    def _call(self, submitted: float, fn: Callable[..., T], args: Tuple[Any, ...], kwargs: Dict[str, Any]) -> T:
+        started = time.perf_counter()
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_time += started - submitted
+        ok = False
+        try:
+            result = fn(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.run_time += time.perf_counter() - started
+                if ok:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+    async def run(self, fn: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        """Run `fn(*args, **kwargs)` on the pool"""
+        with self._lock:
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        return await asyncio.get_running_loop().run_in_executor(
+            self.pool, self._call, time.perf_counter(), fn, args, kwargs
+        )
+
+    async def iterate(self, iterator: Iterator[T]) -> AsyncIterator[T]:
+        """Drive a blocking iterator (e.g. chunked file reads) from the pool"""
+        while True:
+            item = await self.run(next, iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+
+    async def subprocess(self, *cmd: str) -> Tuple[int, str, str]:
+        """Run a command as an async subprocess
+        :return: The exit code, stdout and stderr.
+        """
+        started = time.perf_counter()
+        process = await asyncio.create_subprocess_exec(
+            *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        self.subprocesses += 1
+        self.subprocess_time += time.perf_counter() - started
+        return process.returncode or 0, stdout.decode(errors="replace"), stderr.decode(errors="replace")
+
+    def metrics(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queued": self.queued,
+                "running": self.running,
+                "max_queued": self.max_queued,
+                "completed": self.completed,
+                "failed": self.failed,
+                "wait_time": self.wait_time,
+                "run_time": self.run_time,
+                "subprocesses": self.subprocesses,
+                "subprocess_time": self.subprocess_time,
+            }
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+executor = BlockingExecutor(env.EXECUTOR_WORKERS)
@@ -0,0 +1,155 @@
+"""In-process background job queue for builds and deploys"""
+import time
+import asyncio
+from enum import Enum
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+from pydantic import BaseModel, Field
+from src.config import env
+from src.utils import gen_oid
+
+
+class JobState(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+class Job(BaseModel):
+    """A build or deploy run, with its timings and the events it logged"""
+    id: str = Field(default_factory=gen_oid)
+    kind: str = Field(...)
+    key: Tuple[str, ...] = Field(...)
+    state: JobState = Field(default=JobState.queued)
+    created_at: float = Field(default_factory=time.time)
+    started_at: Optional[float] = Field(default=None)
+    finished_at: Optional[float] = Field(default=None)
+    result: Any = Field(default=None)
+    error: Optional[str] = Field(default=None)
+    events: List[Dict[str, Any]] = Field(default_factory=list)
+
+    class Config:
+        underscore_attrs_are_private = True
+
+    _changed: Optional[asyncio.Event] = None
+
+    @property
+    def done(self) -> bool:
+        return self.state in (JobState.succeeded, JobState.failed)
+
+    def log(self, event: Dict[str, Any]) -> None:
+        """Append an event and wake up followers"""
+        self.events.append(event)
+        self._notify()
+
+    def _notify(self) -> None:
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    async def follow(self, offset: int = 0) -> AsyncIterator[Dict[str, Any]]:
+        """Yield the events from `offset` on, waiting for new ones until the job is done"""
+        while True:
+            while offset < len(self.events):
+                yield self.events[offset]
+                offset += 1
+            if self.done:
+                return
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            await self._changed.wait()
+
+    def status(self) -> Dict[str, Any]:
+        """Job state without the events, plus the offset the log is at"""
+        return {
+            **self.dict(exclude={"events"}),
+            "log_offset": len(self.events),
+            "duration": (self.finished_at or time.time()) - self.started_at
+            if self.started_at
+            else None,
+        }
+
+
+class JobQueue:
+    """
+    Runs submitted jobs in the background, at most `concurrency` at a time.
+    Submitting a job whose key matches a queued or running one returns that job instead.
+    Only the last `history` finished jobs are kept.
+    """
+
+    def __init__(self, concurrency: int, history: int = 200):
+        self.concurrency = concurrency
+        self.history = history
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._active: Dict[Tuple[str, ...], Job] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self._semaphore
+
+    def submit(self, kind: str, key: Tuple[str, ...], body: Callable[[Job], Awaitable[Any]]) -> Job:
+        """Queue `body(job)` unless an identical job is already queued or running"""
+        key = (kind, *key)
+        if key in self._active:
+            return self._active[key]
+        job = Job(kind=kind, key=key)
+        self.jobs[job.id] = job
+        self._active[key] = job
+        self._tasks[job.id] = asyncio.create_task(self._run(job, body))
+        return job
+
+    async def _run(self, job: Job, body: Callable[[Job], Awaitable[Any]]) -> None:
+        try:
+            async with self.semaphore:
+                job.state = JobState.running
+                job.started_at = time.time()
+                job._notify()
+                job.result = await body(job)
+                if isinstance(job.result, dict) and "error" in job.result:
+                    job.state, job.error = JobState.failed, str(job.result["error"])
+                else:
+                    job.state = JobState.succeeded
+        except asyncio.CancelledError:
+            job.state, job.error = JobState.failed, "cancelled"
+            raise
+        except Exception as exc:
+            job.state, job.error = JobState.failed, repr(exc)
+        finally:
+            job.finished_at = time.time()
+            self._active.pop(job.key, None)
+            self._tasks.pop(job.id, None)
+            job._notify()
+            self._trim()
+
+    def _trim(self) -> None:
+        finished = [id_ for id_, job in self.jobs.items() if job.done]
+        for id_ in finished[: max(len(finished) - self.history, 0)]:
+            del self.jobs[id_]
+
+    def get(self, id_: str) -> Optional[Job]:
+        return self.jobs.get(id_)
+
+    def list(self, kind: Optional[str] = None, state: Optional[JobState] = None) -> List[Job]:
+        return [
+            job
+            for job in reversed(self.jobs.values())
+            if (kind is None or job.kind == kind) and (state is None or job.state == state)
+        ]
+
+    async def wait(self, job: Job) -> Job:
+        async for _ in job.follow(len(job.events)):
+            pass
+        return job
+
+    async def shutdown(self) -> None:
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+jobs = JobQueue(env.BUILD_CONCURRENCY, env.JOB_HISTORY)
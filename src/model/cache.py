@@ -0,0 +1,116 @@
+"""Read-through caches for FaunaModel lookups, keyed by (model, field, value)"""
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+MISSING = object()
+NOT_FOUND = object()
+
+
+class CacheBackend:
+    """
+    Where a model cache keeps its entries. `get` returns MISSING for keys that
+    aren't cached or expired; implement it with `set`, `delete` and `clear` to plug in a shared store.
+    """
+
+    def get(self, key: Hashable) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        raise NotImplementedError
+
+    def delete(self, key: Hashable) -> None:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+
+class LRUBackend(CacheBackend):
+    """In-process LRU of at most `maxsize` entries, each expiring after its ttl (thread safe)"""
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ModelCache:
+    """
+    Read-through cache of single-document lookups. Documents live for `ttl` seconds,
+    lookups that found nothing are remembered for `negative_ttl` seconds.
+    """
+
+    def __init__(self, backend: Optional[CacheBackend] = None, ttl: float = 60.0, negative_ttl: float = 10.0):
+        self.backend = backend if backend is not None else LRUBackend()
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.hits = 0
+        self.misses = 0
+        self.negative_hits = 0
+
+    def get_or_load(
+        self, key: Hashable, load: Callable[[], Optional[Dict[str, Any]]]
+    ) -> Optional[Dict[str, Any]]:
+        """The cached document of `key`, calling `load` (and caching its result, None included) on a miss"""
+        value = self.backend.get(key)
+        if value is NOT_FOUND:
+            self.hits += 1
+            self.negative_hits += 1
+            return None
+        if value is not MISSING:
+            self.hits += 1
+            return dict(value)
+        self.misses += 1
+        document = load()
+        if document is None:
+            self.backend.set(key, NOT_FOUND, self.negative_ttl)
+        else:
+            self.backend.set(key, dict(document), self.ttl)
+        return document
+
+    def invalidate(self, key: Hashable) -> None:
+        self.backend.delete(key)
+
+    def clear(self) -> None:
+        self.backend.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "negative_hits": self.negative_hits,
+            "hit_ratio": self.hits / lookups if lookups else None,
+        }
@@ -2,25 +2,48 @@
    the fauna query object is available also within the class for further customization
 """
 from __future__ import annotations
-from typing import List, Optional, Any, Dict
+import threading
+from typing import AsyncIterator, Callable, ClassVar, Iterator, List, Optional, Any, Dict, Tuple
 from pydantic import BaseModel, Field
 from faunadb import query as q
 from faunadb.objects import Query
 from faunadb.client import FaunaClient
 from faunadb.errors import NotFound, BadRequest
 from src.config import env
+from src.executor import executor
+from src.model.cache import ModelCache
 from src.utils import gen_oid, gen_now
 
+PAGE_SIZE = 1000
+BATCH_SIZE = 100
+
+_client:Optional[FaunaClient] = None
+_client_lock = threading.Lock()
+
+
+def get_client()->FaunaClient:
+    """The FaunaClient of the process, created on first use and shared by every model and thread"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = FaunaClient(secret=env.FAUNA_SECRET)
+    return _client
+
 
 class FaunaModel(BaseModel):
     """FaunaDB Model"""
     oid: str = Field(default_factory=gen_oid, alias="id", index=True, unique=True)
     created_at:str = Field(default_factory=gen_now, alias="createdAt")
+    # optional read-through cache of find, find_unique, find_one and exists
+    cache:ClassVar[Optional[ModelCache]] = None
+    # indexed (non unique) fields whose find_one lookups are cached too
+    cache_fields:ClassVar[Tuple[str, ...]] = ()
     
     @classmethod
     def client(cls)->FaunaClient:
-        """Return a FaunaClient"""
-        return FaunaClient(secret=env.FAUNA_SECRET)
+        """Return the shared FaunaClient"""
+        return get_client()
     
     @classmethod
     def q(cls)->Query:
@@ -28,99 +51,285 @@ class FaunaModel(BaseModel):
         return cls.client().query
     
     @classmethod
-    def provision(cls)->None:
-        """Provision the collection and indexes"""
-        _q = cls.q()
-        try:
-            if not _q(q.exists(q.collection(cls.__name__.lower()))):
-                _q(q.create_collection({"name": cls.__name__.lower()}))
-                print(f"Created collection {cls.__name__.lower()}")
-                _q(q.create_index({
-                    "name": cls.__name__.lower(),
-                    "source": q.collection(cls.__name__.lower())
-                }))
-                print(f"Created index {cls.__name__.lower()}")
-            for field in cls.__fields__.values():
-                if field.field_info.extra.get("index"):
-                    _q(q.create_index({
-                        "name": f"{cls.__name__.lower()}_{field.name}",
-                        "source": q.collection(cls.__name__.lower()),
-                        "terms": [{"field": ["data", field.name]}]
-                    }))
-                    print(f"Created index {cls.__name__.lower()}_{field.name}")
-                if field.field_info.extra.get("unique"):
-                    _q(q.create_index({
-                        "name": f"{cls.__name__.lower()}_{field.name}_unique",
-                        "source": q.collection(cls.__name__.lower()),
-                        "terms": [{"field": ["data", field.name]}],
-                        "unique": True
-                    }))
-                    print(f"Created unique index {cls.__name__.lower()}_{field.name}_unique")
-        except BadRequest as exc:
-            print(exc)
-            
+    def index_definitions(cls)->List[Dict[str, Any]]:
+        """The indexes the model queries: one over the whole collection, `{name}_{field}` for
+        each `index=True` field and `{name}_{field}_unique` for each `unique=True` one
+        """
+        name = cls.__name__.lower()
+        indexes: List[Dict[str, Any]] = [{"name": name}]
+        for field in cls.__fields__.values():
+            terms = [{"field": ["data", field.name]}]
+            if field.field_info.extra.get("index"):
+                indexes.append({"name": f"{name}_{field.name}", "terms": terms})
+            if field.field_info.extra.get("unique"):
+                indexes.append({"name": f"{name}_{field.name}_unique", "terms": terms, "unique": True})
+        return indexes
+
+    @classmethod
+    def provision(cls, dry_run:bool=False)->Dict[str, Any]:
+        """Provision the collection and indexes (see `src.model.provision`)"""
+        from src.model.provision import provision_models
+        return provision_models([cls], dry_run=dry_run)
+
+    @classmethod
+    def _cached(cls, field:str, value:Any, load:Callable[[], Optional[Dict[str, Any]]])->Optional[Dict[str, Any]]:
+        """Look a document up through the model cache, when there is one"""
+        if cls.cache is None:
+            return load()
+        return cls.cache.get_or_load((cls.__name__.lower(), field, value), load)
+
+    @classmethod
+    def _invalidate(cls, *documents:Optional[Dict[str, Any]])->None:
+        """Forget the cached lookups of each document by its unique and `cache_fields` fields"""
+        if cls.cache is None:
+            return
+        for document in documents:
+            if not document or "conflicts" in document:
+                continue
+            for field in [*cls._unique_fields(), *cls.cache_fields]:
+                if field in document:
+                    cls.cache.invalidate((cls.__name__.lower(), field, document[field]))
+
     @classmethod
     def exists(cls, oid:str)->bool:
         """Check if a document exists"""
+        if cls.cache is not None:
+            return cls.find(oid) is not None
         return cls.q()(q.exists(q.match(q.index(f"{cls.__name__.lower()}_oid"), oid)))
     
     @classmethod
     def find_unique(cls, field:str, value:Any)->Optional[Dict[str, Any]]:
         """Find a document by a unique field"""
-        try:
-            return cls.q()(q.get(q.match(q.index(f"{cls.__name__.lower()}_{field}_unique"), value)))["data"]
-        except NotFound:
-            return None
+        def load()->Optional[Dict[str, Any]]:
+            try:
+                return cls.q()(q.get(q.match(q.index(f"{cls.__name__.lower()}_{field}_unique"), value)))["data"]
+            except NotFound:
+                return None
+        return cls._cached(field, value, load)
+
+    @classmethod
+    def find_one(cls, field:str, value:Any)->Optional[Dict[str, Any]]:
+        """Find the first document whose indexed `field` is `value` (cached for `cache_fields`)"""
+        def load()->Optional[Dict[str, Any]]:
+            try:
+                return cls.q()(q.get(q.match(q.index(f"{cls.__name__.lower()}_{field}"), value)))["data"]
+            except NotFound:
+                return None
+        if field not in cls.cache_fields:
+            return load()
+        return cls._cached(field, value, load)
         
     @classmethod
-    def find_many(cls, field:str, value:Any)->List[Dict[str, Any]]:
-        """Find documents by a field"""
-        ref = cls.q()(q.paginate(q.match(q.index(f"{cls.__name__.lower()}_{field}"), value)))["data"]
-        return [cls.q()(q.get(ref))["data"] for ref in ref]
+    def _match(cls, field:Optional[str]=None, value:Any=None)->Query:
+        """Every document of the collection, or the ones whose `field` is `value`"""
+        if field is None:
+            return q.match(q.index(cls.__name__.lower()))
+        return q.match(q.index(f"{cls.__name__.lower()}_{field}"), value)
+
+    @classmethod
+    def find_page(cls, field:Optional[str]=None, value:Any=None, size:int=PAGE_SIZE, after:Any=None)->Dict[str, Any]:
+        """Fetch a page of documents in one query
+        :return: The documents under "data" and the cursor of the next page under "after" (None on the last page).
+        """
+        page = cls.q()(q.map_(
+            q.lambda_("ref", q.select("data", q.get(q.var("ref")))),
+            q.paginate(cls._match(field, value), size=size, after=after)
+        ))
+        return {"data": page["data"], "after": page.get("after")}
+
+    @classmethod
+    def pages(cls, field:Optional[str]=None, value:Any=None, size:int=PAGE_SIZE)->Iterator[List[Dict[str, Any]]]:
+        """Yield every page of documents, one query each"""
+        after = None
+        while True:
+            page = cls.find_page(field, value, size, after)
+            yield page["data"]
+            after = page["after"]
+            if after is None:
+                return
+
+    @classmethod
+    def find_many(cls, field:str, value:Any, size:Optional[int]=None, after:Any=None)->List[Dict[str, Any]]:
+        """Find documents by a field: all of them, or the page of `size` starting at the `after` cursor"""
+        if size is None and after is None:
+            return [doc for page in cls.pages(field, value) for doc in page]
+        return cls.find_page(field, value, size or PAGE_SIZE, after)["data"]
     
     @classmethod
     def find(cls, oid:str)->Optional[Dict[str, Any]]:
         """Find a document by id"""
-        try:
-            setref =  cls.q()(q.match(q.index(f"{cls.__name__.lower()}_oid_unique"), oid))
-            return cls.q()(q.get(setref))["data"]
-        except NotFound:
-            return None
+        return cls.find_unique("oid", oid)
         
     @classmethod
-    def find_all(cls)->List[Dict[str, Any]]:
-        """Find all documents"""
-        refs = cls.q()(q.paginate(q.match(q.index(cls.__name__.lower()))))["data"]
-        return [cls.q()(q.get(ref))["data"] for ref in refs]
+    def find_all(cls, size:Optional[int]=None, after:Any=None)->List[Dict[str, Any]]:
+        """Find all documents, or the page of `size` starting at the `after` cursor"""
+        if size is None and after is None:
+            return [doc for page in cls.pages() for doc in page]
+        return cls.find_page(None, None, size or PAGE_SIZE, after)["data"]
     
     @classmethod
     def delete_unique(cls, field:str, value:Any)->bool:
         """Delete a document by a unique field"""
-        try:
-            ref = cls.q()(q.get(q.match(q.index(f"{cls.__name__.lower()}_{field}_unique"), value)))
-            cls.q()(q.delete(ref["ref"]))
-            return True
-        except NotFound:
-            return False
+        deleted = cls.q()(cls._delete_expr(field, value))
+        cls._invalidate(deleted)
+        return deleted is not None
         
     @classmethod
     def delete(cls, oid:str)->bool:
         """Delete a document by id"""
-        try:
-            ref = cls.q()(q.get(q.match(q.index(f"{cls.__name__.lower()}_oid_unique"), oid)))
-            cls.q()(q.delete(ref["ref"]))
-            return True
-        except NotFound:
-            return False
+        return cls.delete_unique("oid", oid)
     
+    @classmethod
+    def _unique_fields(cls)->List[str]:
+        return [field.name for field in cls.__fields__.values() if field.field_info.extra.get("unique")]
+
+    @classmethod
+    def _lookup(cls, field:str, value:Any)->Query:
+        """Set of the documents whose `field` is `value`, through its unique index when it has one"""
+        if field in cls._unique_fields():
+            return q.match(q.index(f"{cls.__name__.lower()}_{field}_unique"), value)
+        return q.match(q.index(f"{cls.__name__.lower()}_{field}"), value)
+
+    @classmethod
+    def _create_expr(cls, data:Dict[str, Any])->Query:
+        """Create `data` unless another document holds one of its unique values,
+        in which case the expression evaluates to {"conflicts": [field, ...]} instead
+        """
+        taken = q.filter_(
+            q.lambda_("field", q.not_(q.is_null(q.var("field")))),
+            [q.if_(q.exists(cls._lookup(field, data.get(field))), field, None) for field in cls._unique_fields()]
+        )
+        return q.let(
+            {"taken": taken},
+            q.if_(
+                q.is_empty(q.var("taken")),
+                q.create(q.collection(cls.__name__.lower()), {"data": data}),
+                {"conflicts": q.var("taken")}
+            )
+        )
+
+    @classmethod
+    def _upsert_expr(cls, data:Dict[str, Any], field:str)->Query:
+        """Update the document whose `field` matches `data` (keeping its id and creation date), or create it.
+        An update evaluates to {"data": new data, "prior": data before the update}.
+        """
+        changes = {key: value for key, value in data.items() if key not in ("oid", "created_at")}
+        return q.let(
+            {"match": cls._lookup(field, data.get(field))},
+            q.if_(
+                q.exists(q.var("match")),
+                q.let(
+                    {"prior": q.get(q.var("match"))},
+                    {
+                        "data": q.select("data", q.update(q.select("ref", q.var("prior")), {"data": changes})),
+                        "prior": q.select("data", q.var("prior"))
+                    }
+                ),
+                cls._create_expr(data)
+            )
+        )
+
+    @classmethod
+    def _delete_expr(cls, field:str, value:Any)->Query:
+        """Delete the document whose `field` is `value`, evaluating to its data (null when there was none)"""
+        return q.let(
+            {"match": cls._lookup(field, value)},
+            q.if_(
+                q.exists(q.var("match")),
+                q.select("data", q.delete(q.select("ref", q.get(q.var("match"))))),
+                None
+            )
+        )
+
+    @staticmethod
+    def _document(res:Dict[str, Any])->Dict[str, Any]:
+        """The data of a written document, or the conflicts of a rejected one"""
+        return res if "conflicts" in res else res["data"]
+
+    @staticmethod
+    def _clashes(rows:List[Dict[str, Any]], fields:List[str])->List[List[str]]:
+        """For each row, the `fields` whose value an earlier row of the list already claims.
+        The uniqueness checks of a query don't see the writes made earlier in the same
+        query, so such rows are kept out of it and reported as conflicts.
+        """
+        seen: Dict[str, set] = {field: set() for field in fields}
+        clashes: List[List[str]] = []
+        for row in rows:
+            taken = [field for field in fields if row.get(field) is not None and row[field] in seen[field]]
+            if not taken:
+                for field in fields:
+                    if row.get(field) is not None:
+                        seen[field].add(row[field])
+            clashes.append(taken)
+        return clashes
+
+    @classmethod
+    def _batched(cls, exprs:List[Query], batch_size:int)->List[Any]:
+        """Run a list of expressions, `batch_size` of them per query (each query is one transaction)"""
+        _q = cls.q()
+        results: List[Any] = []
+        for start in range(0, len(exprs), batch_size):
+            results.extend(_q(exprs[start:start + batch_size]))
+        return results
+
+    @classmethod
+    def create_many(cls, items:List[FaunaModel], batch_size:int=BATCH_SIZE)->List[Dict[str, Any]]:
+        """Create documents, `batch_size` per query, uniqueness checked server-side
+        :return: The data of each created document, or {"conflicts": [field, ...]} for the ones that clashed.
+        """
+        rows = [item.dict() for item in items]
+        clashes = cls._clashes(rows, cls._unique_fields())
+        results = iter(cls._batched([cls._create_expr(row) for row, taken in zip(rows, clashes) if not taken], batch_size))
+        documents = [{"conflicts": taken} if taken else cls._document(next(results)) for taken in clashes]
+        cls._invalidate(*documents)
+        return documents
+
+    @classmethod
+    def upsert_many(cls, items:List[FaunaModel], field:str="oid", batch_size:int=BATCH_SIZE)->List[Dict[str, Any]]:
+        """Update or create documents matched on `field`, `batch_size` per query
+        Items repeating the `field` or a unique value of an earlier item are not written.
+        :return: The data of each written document, or {"conflicts": [field, ...]} for the ones that clashed.
+        """
+        rows = [item.dict() for item in items]
+        clashes = cls._clashes(rows, list(dict.fromkeys([field, *cls._unique_fields()])))
+        results = cls._batched([cls._upsert_expr(row, field) for row, taken in zip(rows, clashes) if not taken], batch_size)
+        written = iter(results)
+        documents = [{"conflicts": taken} if taken else cls._document(next(written)) for taken in clashes]
+        cls._invalidate(*documents, *[res.get("prior") for res in results])
+        return documents
+
+    @classmethod
+    def delete_many(cls, values:List[Any], field:str="oid", batch_size:int=BATCH_SIZE)->List[bool]:
+        """Delete the documents whose `field` is one of `values`, `batch_size` per query
+        :return: Whether each document existed.
+        """
+        deleted = cls._batched([cls._delete_expr(field, value) for value in values], batch_size)
+        cls._invalidate(*deleted)
+        return [document is not None for document in deleted]
+
     def create(self)->Dict[str, Any]:
         """Create a document"""
         try:
-            for field in self.__fields__.values():
-                if field.field_info.extra.get("unique"):
-                    if self.find_unique(field.name, getattr(self, field.name)):
-                        raise ValueError(f"{field.name} must be unique")
-            return self.q()(q.create(q.collection(self.__class__.__name__.lower()), {"data": self.dict()}))
+            res = self.q()(self._create_expr(self.dict()))
+            if "conflicts" in res:
+                raise ValueError(f"{res['conflicts'][0]} must be unique")
+            self._invalidate(res["data"])
+            return res
+        except BadRequest as exc:
+            print(exc)
+            return {}
+
+    def upsert(self, field:str="oid", value:Any=None)->Dict[str, Any]:
+        """Update the document whose `field` is `value` (this model's own value by default) or create it, in one query"""
+        data = self.dict()
+        if value is not None:
+            data[field] = value
+        try:
+            res = self.q()(self._upsert_expr(data, field))
+            if "conflicts" in res:
+                raise ValueError(f"{res['conflicts'][0]} must be unique")
+            self._invalidate(data, res["data"], res.get("prior"))
+            return res["data"]
         except BadRequest as exc:
             print(exc)
             return {}
@@ -129,17 +338,104 @@ class FaunaModel(BaseModel):
         """Update a document"""
         _q = self.q()
         try:
-            ref = _q(q.get(q.match(q.index(f"{self.__class__.__name__.lower()}_id"), self.oid)))
-            return _q(q.update(ref, {"data": self.dict()}))
+            ref = _q(q.get(q.match(q.index(f"{self.__class__.__name__.lower()}_oid_unique"), self.oid)))
+            res = _q(q.update(ref["ref"], {"data": self.dict()}))
+            self._invalidate(ref["data"], res["data"])
+            return res
         except NotFound:
             return {}
         
     def save(self)->Dict[str, Any]:
         """Save a document"""
         try:
-            if self.exists(self.oid):
-               return self.dict()
-            return self.create()["data"]
+            res = self.q()(q.if_(
+                q.exists(self._lookup("oid", self.oid)),
+                None,
+                self._create_expr(self.dict())
+            ))
+            if res is None:
+                return self.dict()
+            if "conflicts" in res:
+                raise ValueError(f"{res['conflicts'][0]} must be unique")
+            self._invalidate(res["data"])
+            return res["data"]
         except BadRequest as exc:
             print(exc)
-            return {}
\ No newline at end of file
+            return {}
+
+    # Awaitable versions, run on the blocking executor so handlers don't stall the event loop
+
+    @classmethod
+    async def aprovision(cls, dry_run:bool=False)->Dict[str, Any]:
+        return await executor.run(cls.provision, dry_run)
+
+    @classmethod
+    async def aexists(cls, oid:str)->bool:
+        return await executor.run(cls.exists, oid)
+
+    @classmethod
+    async def afind_unique(cls, field:str, value:Any)->Optional[Dict[str, Any]]:
+        return await executor.run(cls.find_unique, field, value)
+
+    @classmethod
+    async def afind_many(cls, field:str, value:Any, size:Optional[int]=None, after:Any=None)->List[Dict[str, Any]]:
+        return await executor.run(cls.find_many, field, value, size, after)
+
+    @classmethod
+    async def afind_page(cls, field:Optional[str]=None, value:Any=None, size:int=PAGE_SIZE, after:Any=None)->Dict[str, Any]:
+        return await executor.run(cls.find_page, field, value, size, after)
+
+    @classmethod
+    async def apages(cls, field:Optional[str]=None, value:Any=None, size:int=PAGE_SIZE)->AsyncIterator[List[Dict[str, Any]]]:
+        """Stream every page of documents (all of them, or the ones whose `field` is `value`)"""
+        after = None
+        while True:
+            page = await cls.afind_page(field, value, size, after)
+            yield page["data"]
+            after = page["after"]
+            if after is None:
+                return
+
+    @classmethod
+    async def afind_one(cls, field:str, value:Any)->Optional[Dict[str, Any]]:
+        return await executor.run(cls.find_one, field, value)
+
+    @classmethod
+    async def afind(cls, oid:str)->Optional[Dict[str, Any]]:
+        return await executor.run(cls.find, oid)
+
+    @classmethod
+    async def afind_all(cls, size:Optional[int]=None, after:Any=None)->List[Dict[str, Any]]:
+        return await executor.run(cls.find_all, size, after)
+
+    @classmethod
+    async def adelete_unique(cls, field:str, value:Any)->bool:
+        return await executor.run(cls.delete_unique, field, value)
+
+    @classmethod
+    async def adelete(cls, oid:str)->bool:
+        return await executor.run(cls.delete, oid)
+
+    async def acreate(self)->Dict[str, Any]:
+        return await executor.run(self.create)
+
+    async def aupdate(self)->Dict[str, Any]:
+        return await executor.run(self.update)
+
+    async def asave(self)->Dict[str, Any]:
+        return await executor.run(self.save)
+
+    async def aupsert(self, field:str="oid", value:Any=None)->Dict[str, Any]:
+        return await executor.run(self.upsert, field, value)
+
+    @classmethod
+    async def acreate_many(cls, items:List[FaunaModel], batch_size:int=BATCH_SIZE)->List[Dict[str, Any]]:
+        return await executor.run(cls.create_many, items, batch_size)
+
+    @classmethod
+    async def aupsert_many(cls, items:List[FaunaModel], field:str="oid", batch_size:int=BATCH_SIZE)->List[Dict[str, Any]]:
+        return await executor.run(cls.upsert_many, items, field, batch_size)
+
+    @classmethod
+    async def adelete_many(cls, values:List[Any], field:str="oid", batch_size:int=BATCH_SIZE)->List[bool]:
+        return await executor.run(cls.delete_many, values, field, batch_size)
@@ -0,0 +1,123 @@
+"""Idempotent provisioning of the collections and indexes of every FaunaModel"""
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
+from faunadb import query as q
+from faunadb.errors import BadRequest
+from src.executor import executor
+from src.model.orm import FaunaModel, get_client
+from src.model import schemas  # noqa: F401 (defines the models)
+
+LIST_SIZE = 100000
+
+
+def all_models() -> List[Type[FaunaModel]]:
+    """Every FaunaModel subclass, at any depth"""
+    found: List[Type[FaunaModel]] = []
+    pending = list(FaunaModel.__subclasses__())
+    while pending:
+        model = pending.pop(0)
+        if model not in found:
+            found.append(model)
+            pending.extend(model.__subclasses__())
+    return found
+
+
+def wanted(models: List[Type[FaunaModel]]) -> Tuple[List[str], Dict[str, Dict[str, Any]]]:
+    """The collection names and the index definitions (by name) of `models`"""
+    collections: List[str] = []
+    indexes: Dict[str, Dict[str, Any]] = {}
+    for model in models:
+        collection = model.__name__.lower()
+        collections.append(collection)
+        for index in model.index_definitions():
+            indexes[index["name"]] = {**index, "source": collection}
+    return collections, indexes
+
+
+def existing() -> Tuple[Set[str], Dict[str, bool]]:
+    """The collection names and index names (with whether they're active) of the database, in one query"""
+    res = get_client().query({
+        "collections": q.select("data", q.map_(
+            q.lambda_("ref", q.select("name", q.get(q.var("ref")))),
+            q.paginate(q.collections(), size=LIST_SIZE)
+        )),
+        "indexes": q.select("data", q.map_(
+            q.lambda_("ref", q.let(
+                {"index": q.get(q.var("ref"))},
+                [q.select("name", q.var("index")), q.select("active", q.var("index"), False)]
+            )),
+            q.paginate(q.indexes(), size=LIST_SIZE)
+        )),
+    })
+    return set(res["collections"]), {name: active for name, active in res["indexes"]}
+
+
+def _create_index(index: Dict[str, Any]) -> Any:
+    params = {**index, "source": q.collection(index["source"])}
+    return q.create_index(params)
+
+
+def wait_active(names: List[str], timeout: float = 60.0, interval: float = 0.5) -> List[str]:
+    """Poll until the indexes `names` are built
+    :return: The ones still building when `timeout` ran out.
+    """
+    pending = list(names)
+    deadline = time.monotonic() + timeout
+    while pending:
+        active = get_client().query([q.select("active", q.get(q.index(name)), False) for name in pending])
+        pending = [name for name, ok in zip(pending, active) if not ok]
+        if not pending or time.monotonic() >= deadline:
+            break
+        time.sleep(interval)
+    return pending
+
+
+def provision_models(
+    models: Optional[List[Type[FaunaModel]]] = None,
+    dry_run: bool = False,
+    timeout: float = 60.0,
+    attempts: int = 3,
+) -> Dict[str, Any]:
+    """
+    Make sure the collections and indexes of `models` (every FaunaModel by default) exist:
+    - one query lists what the database has,
+    - one query creates every missing collection, one more every missing index,
+    - then index builds are polled until active (up to `timeout` seconds).
+    Safe to run concurrently: when another process created something first, the diff is redone.
+    With `dry_run` only the plan is returned.
+    """
+    collections, indexes = wanted(models if models is not None else all_models())
+    for attempt in range(attempts):
+        have_collections, have_indexes = existing()
+        missing_collections = [name for name in collections if name not in have_collections]
+        missing_indexes = [name for name in indexes if name not in have_indexes]
+        report: Dict[str, Any] = {
+            "dry_run": dry_run,
+            "collections": missing_collections,
+            "indexes": missing_indexes,
+            "building": [name for name in indexes if have_indexes.get(name) is False],
+        }
+        if dry_run:
+            return report
+        try:
+            # a collection has to exist before the query that indexes it
+            if missing_collections:
+                get_client().query([q.create_collection({"name": name}) for name in missing_collections])
+                print(f"Created collections {', '.join(missing_collections)}")
+            if missing_indexes:
+                get_client().query([_create_index(indexes[name]) for name in missing_indexes])
+                print(f"Created indexes {', '.join(missing_indexes)}")
+        except BadRequest as exc:
+            if attempt == attempts - 1:
+                raise
+            print(f"Provisioning raced another writer, retrying: {exc}")
+            continue
+        report["building"] = wait_active(sorted(set(missing_indexes) | set(report["building"])), timeout)
+        return report
+    return report
+
+
+async def aprovision_models(
+    models: Optional[List[Type[FaunaModel]]] = None, dry_run: bool = False, timeout: float = 60.0
+) -> Dict[str, Any]:
+    return await executor.run(provision_models, models, dry_run, timeout)
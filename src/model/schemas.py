@@ -1,10 +1,13 @@
 from typing import List, Optional, Union, Any, Dict
 from datetime import datetime
 from src.model.orm import *
+from src.model.cache import LRUBackend, ModelCache
 
 
 class User(FaunaModel):
     """User model."""
+    cache = ModelCache(LRUBackend(env.FAUNA_CACHE_SIZE), env.FAUNA_CACHE_TTL, env.FAUNA_CACHE_NEGATIVE_TTL)
+    cache_fields = ("sub",)
     sub: str = Field(...,index=True)
     nickname: Optional[str] = Field(default=None)
     name:Optional[str] = Field(default=None)
@@ -13,15 +16,21 @@ class User(FaunaModel):
     email:Optional[str] = Field(default=None,index=True)
     email_verified:Optional[bool] = Field(default=None,index=True)
  
-    def upsert(self, sub:str):
-        """Upsert a user."""
-        user = User.q()(q.get(q.match(q.index("user_by_sub"), sub)))
-        if user:
-            user = User(**user["data"])
-            return user.dict()
-        else:
-            self.create()
-        return self.dict()
+    @classmethod
+    def find_by_sub(cls, sub:str)->Optional[Dict[str, Any]]:
+        """Find a user by `sub`, through the cache."""
+        return cls.find_one("sub", sub)
+
+    @classmethod
+    async def afind_by_sub(cls, sub:str)->Optional[Dict[str, Any]]:
+        return await cls.afind_one("sub", sub)
+
+    def upsert(self, field:str="sub", value:Any=None)->Dict[str, Any]:
+        """Upsert a user, matched on `sub` by default, in a single query."""
+        return super().upsert(field, value)
+
+    async def aupsert(self, field:str="sub", value:Any=None)->Dict[str, Any]:
+        return await super().aupsert(field, value)
     
 
 class ContainerCreate(BaseModel):
@@ -0,0 +1,106 @@
+"""Step graphs: run independent async steps concurrently, time them and roll back on failure"""
+import time
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional
+
+Results = Dict[str, Any]
+Log = Callable[[Dict[str, Any]], None]
+
+
+class StepFailed(Exception):
+    """A step of a pipeline raised, the completed steps have been rolled back"""
+
+    def __init__(self, step: str, error: BaseException):
+        super().__init__(f"{step}: {error!r}")
+        self.step = step
+        self.error = error
+
+
+class Step:
+    def __init__(
+        self,
+        name: str,
+        run: Callable[[Results], Awaitable[Any]],
+        after: Iterable[str] = (),
+        undo: Optional[Callable[[Any], Awaitable[Any]]] = None,
+    ):
+        self.name = name
+        self.run = run
+        self.after = list(after)
+        self.undo = undo
+
+
+class Pipeline:
+    """
+    A set of named steps, each starting as soon as the steps it runs `after` are done.
+    A step receives the results of every finished step. When one fails, the
+    steps already running are allowed to finish, the ones not started yet are skipped,
+    and the `undo` of each completed step runs, latest first.
+    """
+
+    def __init__(self, log: Optional[Log] = None):
+        self.steps: Dict[str, Step] = {}
+        self.results: Results = {}
+        self.timings: Dict[str, float] = {}
+        self.completed: List[str] = []
+        self.log = log
+        self.failed = False
+
+    def step(
+        self,
+        name: str,
+        run: Callable[[Results], Awaitable[Any]],
+        after: Iterable[str] = (),
+        undo: Optional[Callable[[Any], Awaitable[Any]]] = None,
+    ) -> "Pipeline":
+        self.steps[name] = Step(name, run, after, undo)
+        return self
+
+    def _emit(self, step: str, state: str, **extra: Any) -> None:
+        if self.log is not None:
+            self.log({"type": "deploy", "step": step, "state": state, **extra})
+
+    async def _run_step(self, step: Step, tasks: Dict[str, "asyncio.Task[Any]"]) -> Any:
+        if step.after:
+            await asyncio.gather(*[tasks[name] for name in step.after])
+        if self.failed:
+            self._emit(step.name, "skipped")
+            return None
+        self._emit(step.name, "started")
+        started = time.perf_counter()
+        try:
+            result = await step.run(self.results)
+        except Exception as exc:
+            self.timings[step.name] = time.perf_counter() - started
+            self._emit(step.name, "failed", duration=self.timings[step.name], error=repr(exc))
+            raise StepFailed(step.name, exc) from exc
+        self.timings[step.name] = time.perf_counter() - started
+        self.results[step.name] = result
+        self.completed.append(step.name)
+        self._emit(step.name, "done", duration=self.timings[step.name])
+        return result
+
+    async def run(self) -> Results:
+        tasks: Dict[str, "asyncio.Task[Any]"] = {}
+        for step in self.steps.values():
+            tasks[step.name] = asyncio.ensure_future(self._run_step(step, tasks))
+        try:
+            await asyncio.gather(*tasks.values())
+        except StepFailed:
+            # in-flight steps finish so whatever they did gets undone too
+            self.failed = True
+            await asyncio.gather(*tasks.values(), return_exceptions=True)
+            await self.rollback()
+            raise
+        return self.results
+
+    async def rollback(self) -> None:
+        for name in reversed(self.completed):
+            step = self.steps[name]
+            if step.undo is None:
+                continue
+            try:
+                await step.undo(self.results[name])
+                self._emit(name, "rolled_back")
+            except Exception as exc:
+                self._emit(name, "rollback_failed", error=repr(exc))
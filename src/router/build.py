@@ -1,58 +1,50 @@
 import os
-import io
+import re
 import json
-import tarfile
-from typing import Any, Dict, Optional, Union, List
-from aiohttp import ClientSession
-from fastapi import APIRouter
-from jinja2 import Template
-from src.config import env, fetch
-from src.utils import build_file_tree, gen_port
+import stat
+import mimetypes
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+from fastapi import APIRouter, Header, HTTPException, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from src.utils import gen_port, read_file_range, safe_join, scan_tree
 from src.api import cloudflare as cf
 from src.api import docker as d
-from src.constants import NGINX_CONFIG, DOCKERFILE, PYTHON_FILE
-
-HEADERS = {
-    "Accept": "application/vnd.github.v3+json",
-    "Authorization": f"token {env.GH_API_KEY}",
-}
-
-
-
+from src.api import github as gh
+from src.api import nginx
+from src.context import pack_directory
+from src.streaming import StreamFormat, event_response, tap
+from src.jobs import Job, JobState, jobs
+from src.executor import executor
+from src.pipeline import Pipeline, StepFailed
+from src.constants import DOCKERFILE, PYTHON_FILE
 
 app = APIRouter()
 
-async def get_latest_commit_sha(owner: str, repo: str) -> str:
-    """
-
-
-    Gets the SHA of the latest commit in the repository.
-
+Log = Callable[[Dict[str, Any]], None]
 
+async def commit_sha(owner: str, repo: str, sha: Optional[str] = None) -> str:
+    """The full SHA of a ref (the latest commit when omitted), 404 when it doesn't exist"""
+    try:
+        return await gh.resolve_commit_sha(owner, repo, sha)
+    except ValueError as exc:
+        raise HTTPException(status_code=404, detail=str(exc))
 
-    :return: The SHA of the latest commit.
+async def git_clone(owner: str, repo: str, sha: Optional[str] = None) -> Tuple[str, str]:
     """
+    Clones (or reuses the cached clone of) a commit, pinned in the clone cache
+    until `gh.clones.release(sha)` is awaited.
+    :return: The commit SHA and the repository root on disk.
+    """
+    sha, path = await gh.clones.get(owner, repo, await commit_sha(owner, repo, sha), pin=True)
+    try:
+        top = (await executor.run(os.listdir, path))[0]
+    except BaseException:
+        await gh.clones.release(sha)
+        raise
+    return sha, os.path.join(path, top)
 
-    url = f"https://api.github.com/repos/{owner}/{repo}/commits"
-
-    payload = await fetch(url, headers=HEADERS)
-    
-    return payload[0]["sha"]
-
-async def git_clone(owner: str, repo: str):
-    async with ClientSession() as session:
-        sha = await get_latest_commit_sha(owner, repo)
-        async with session.get(
-            f"https://api.github.com/repos/{owner}/{repo}/tarball", headers=HEADERS
-        ) as response:
-            response.raise_for_status()
-            content = await response.read()
-            tarball = tarfile.open(fileobj=io.BytesIO(content), mode="r:gz")
-            os.makedirs(f"/containers/{sha}", exist_ok=True)
-            tarball.extractall(path=f"/containers/{sha}")
-            return build_file_tree(f"/containers/{sha}")["children"][0]["children"]
-
-async def get_local_tree(sub:str, name:str):
+def write_local_tree(sub:str, name:str) -> str:
     os.makedirs(f"/containers/{sub}", exist_ok=True)
     os.makedirs(f"/containers/{sub}/{name}", exist_ok=True)
     with open(f"/containers/{sub}/{name}/main.py", "w") as f:
@@ -61,129 +53,374 @@ async def get_local_tree(sub:str, name:str):
         f.write(DOCKERFILE)
     with open(f"/containers/{sub}/{name}/requirements.txt", "w") as f:
         f.write("flask")
+    return f"/containers/{sub}/{name}"
+
+def file_size(path: str) -> Optional[int]:
+    """Size of a regular file, None when it's missing or not a file"""
+    try:
+        info = os.stat(path)
+    except OSError:
+        return None
+    return info.st_size if stat.S_ISREG(info.st_mode) else None
 
-    return build_file_tree(f"/containers/{sub}/{name}")["children"]
+async def file_response(root: str, path: str, range_header: Optional[str] = None) -> StreamingResponse:
+    """
+    Streams a single file of a tree, honouring a `Range: bytes=start-end` header.
+    """
+    try:
+        full = safe_join(root, path)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    size = await executor.run(file_size, full)
+    if size is None:
+        raise HTTPException(status_code=404, detail=f"File not found: {path}")
+    media_type = mimetypes.guess_type(full)[0] or "application/octet-stream"
+    headers = {"Accept-Ranges": "bytes"}
+    if not range_header:
+        headers["Content-Length"] = str(size)
+        return StreamingResponse(
+            executor.iterate(read_file_range(full)), headers=headers, media_type=media_type
+        )
+    match = re.match(r"^bytes=(\d*)-(\d*)$", range_header.strip())
+    if not match or match.groups() == ("", ""):
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    first, last = match.groups()
+    if first:
+        start, end = int(first), min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1
+    if start > end:
+        raise HTTPException(status_code=416, headers={"Content-Range": f"bytes */{size}"})
+    headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        executor.iterate(read_file_range(full, start, end)),
+        status_code=206,
+        headers=headers,
+        media_type=media_type,
+    )
+
+async def tree_listing(root: str, path: str, depth: int, offset: int, limit: Optional[int], hash: bool):
+    try:
+        return await executor.run(scan_tree, root, path, depth, offset, limit, hash)
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=f"Directory not found: {path}")
     
-async def docker_build_from_github_tarball(owner: str, repo: str):
+def docker_build_events(
+    context: AsyncIterator[bytes], params: Optional[Dict[str, Any]] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Streams a build context into the docker /build endpoint.
+    :param context: The tar (optionally gzipped) chunks of the build context.
+    :param params: Extra build query parameters.
+    :return: The step/log/progress/error/image events of the build as they arrive.
     """
-    Builds a Docker image from the latest code for the given GitHub repository.
+    return d.build_events(
+        d.engine.build(
+            params={"dockerfile": "Dockerfile", **(params or {})},
+            data=context,
+            headers={"Content-Type": "application/x-tar"},
+        )
+    )
+
+async def github_build_events(
+    owner: str, repo: str, sha: Optional[str] = None
+) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Builds a Docker image from the given (or latest) commit of a GitHub repository,
+    using the local clone cache as build context.
+    :return: The events of the build, starting with the resolved commit.
+    """
+    async with gh.clones.checkout(owner, repo, sha) as (sha, path):
+        yield {"type": "commit", "sha": sha}
+        local_path = (await executor.run(os.listdir, path))[0]
+        build_args = json.dumps({"LOCAL_PATH": local_path})
+        params = {"dockerfile": f"{local_path}/Dockerfile", "buildargs": build_args}
+        async for event in docker_build_events(pack_directory(path), params):
+            yield event
+
+async def docker_build_from_github_tarball(
+    owner: str, repo: str, sha: Optional[str] = None, log: Optional[Log] = None
+):
+    """
+    Builds a Docker image from the given (or latest) commit of a GitHub repository.
     :param owner: The owner of the repository.
     :param repo: The name of the repository.
-    :return: The output of the Docker build.
-    """
-    sha = await get_latest_commit_sha(owner, repo)
-    tarball_url = f"https://api.github.com/repos/{owner}/{repo}/tarball/{sha}"
-    local_path = f"{owner}-{repo}-{sha[:7]}"
-    build_args = json.dumps({"LOCAL_PATH": local_path})
-    async with ClientSession() as session:
-        async with session.post(
-            f"{env.DOCKER_URL}/build?remote={tarball_url}&dockerfile={local_path}/Dockerfile&buildargs={build_args}"
-        ) as response:
-            streamed_data = await response.text()
-            id_ = streamed_data.split("Successfully built ")[1].split("\\n")[0]
-            return id_
-
-
-async def docker_build_from_tree(tree: Union[List[Dict[str, Any]], Dict[str, Any]]):
-    """
-    Builds a Docker image from the given file tree.
-    :param tree: The file tree.
-    :return: The output of the Docker build.
-    """
-    tarball = io.BytesIO()
-    with tarfile.open(fileobj=tarball, mode="w:gz") as tar:
-        if isinstance(tree, dict):
-            tree = [tree]
-        for file in tree:
-            if file["type"] == "file":
-                tarinfo = tarfile.TarInfo(name=file["name"])
-                tarinfo.size = len(file["content"])
-                tarinfo.mtime = 0
-                tar.addfile(tarinfo, io.BytesIO(file["content"].encode("utf-8")))
-            elif file["type"] == "directory":
-                tar.addfile(tarfile.TarInfo(name=file["name"] + "/"))
-                await docker_build_from_tree(file["children"])
-    tarball.seek(0)
-    async with ClientSession() as session:
-        async with session.post(
-            f"{env.DOCKER_URL}/build?dockerfile=Dockerfile", data=tarball.read()
-        ) as response:
-            streamed_data = await response.text()
-            id_ = streamed_data.split("Successfully built ")[1].split("\\n")[0]
-            return id_
-            
+    :param sha: The commit to build, defaults to the latest one.
+    :param log: Called with every build event.
+    :return: The id of the built image, or the build error.
+    """
+    return await d.build_result(tap(github_build_events(owner, repo, sha), log))
+
+
+async def docker_build_from_directory(path: str, log: Optional[Log] = None):
+    """
+    Builds a Docker image using a directory on disk as build context.
+    :param path: The directory holding the Dockerfile.
+    :param log: Called with every build event.
+    :return: The id of the built image, or the build error.
+    """
+    return await d.build_result(tap(docker_build_events(pack_directory(path)), log))
 
 
 @app.get("/tree/{sub}/{name}")
-async def get_tree(sub:str, name:str):
-    return await get_local_tree(sub, name)
+async def get_tree(
+    sub:str,
+    name:str,
+    path: str = "",
+    depth: int = Query(default=1, ge=0),
+    offset: int = Query(default=0, ge=0),
+    limit: Optional[int] = Query(default=None, ge=1),
+    hash: bool = False,
+):
+    root = await executor.run(write_local_tree, sub, name)
+    return await tree_listing(root, path, depth, offset, limit, hash)
+
+@app.get("/tree/{sub}/{name}/file")
+async def get_tree_file(sub:str, name:str, path: str, range: Optional[str] = Header(default=None)):
+    return await file_response(f"/containers/{sub}/{name}", path, range)
+
+async def job_response(job: Job, stream: Optional[StreamFormat], wait: bool):
+    """Job status right away, its events as a stream, or its result once done"""
+    if stream:
+        return event_response(job.follow(), stream)
+    if wait:
+        await jobs.wait(job)
+        return job.result if job.state == JobState.succeeded else job.status()
+    return JSONResponse(job.status(), status_code=202)
 
 @app.post("/tree/{sub}/{name}")
 async def build_container_from_tree(
-    sub:str, name:str):
+    sub:str, name:str, stream: Optional[StreamFormat] = None, wait: bool = False):
+    """
+    Queues a build of a local tree.
+    :param stream: Follow the build events as `ndjson` or `sse`.
+    :param wait: Wait for the build and return the image id.
+    :return: The build job.
+    """
     name = f"{sub}-{name}"
-    image = await docker_build_from_tree(await get_local_tree(sub, name))
-    return image
+    path = await executor.run(write_local_tree, sub, name)
+    job = jobs.submit(
+        "tree", (sub, name), lambda job: docker_build_from_directory(path, log=job.log)
+    )
+    return await job_response(job, stream, wait)
 
 @app.post("/build/{owner}/{repo}")
-async def build(owner: str, repo: str):
+async def build(
+    owner: str, repo: str, sha: Optional[str] = None,
+    stream: Optional[StreamFormat] = None, wait: bool = False,
+):
     """
-    Builds a Docker image from the latest code for the given GitHub repository.
+    Queues a build of the latest code (or the given commit) of a GitHub repository.
     :param owner: The owner of the repository.
     :param repo: The name of the repository.
-    :return: The output of the Docker build.
+    :param stream: Follow the build events as `ndjson` or `sse`.
+    :param wait: Wait for the build and return the image id.
+    :return: The build job.
     """
-    return await docker_build_from_github_tarball(owner, repo)
+    sha = await commit_sha(owner, repo, sha)
+    job = jobs.submit(
+        "build",
+        (owner, repo, sha),
+        lambda job: docker_build_from_github_tarball(owner, repo, sha, log=job.log),
+    )
+    return await job_response(job, stream, wait)
+
+@app.get("/executor")
+async def get_executor_metrics():
+    return executor.metrics()
+
+@app.get("/routes")
+async def get_routes():
+    return nginx.routes.routes
+
+@app.post("/routes/sync")
+async def sync_routes(prune: bool = True):
+    """
+    Rewrites the nginx routes from the running app containers with one validated reload.
+    """
+    filters = {"status": ["running"], "label": [nginx.APP_LABEL]}
+    running = await d.engine.list({"filters": json.dumps(filters)})
+    return await nginx.routes.sync(running, prune=prune)
+
+@app.get("/jobs")
+async def list_jobs(kind: Optional[str] = None, state: Optional[JobState] = None):
+    return [job.status() for job in jobs.list(kind, state)]
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job.status()
+
+@app.get("/jobs/{job_id}/logs")
+async def get_job_logs(
+    job_id: str, offset: int = Query(default=0, ge=0), stream: Optional[StreamFormat] = None
+):
+    """
+    Events logged by a job from `offset` on, or followed live with `stream`.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    if stream:
+        return event_response(job.follow(offset), stream)
+    return {"offset": len(job.events), "events": job.events[offset:], "done": job.done}
 
 
 @app.get("/clone/{owner}/{repo}")
-async def git_clone_endpoint(owner: str, repo: str):
-    return await git_clone(owner, repo)
+async def git_clone_endpoint(
+    owner: str,
+    repo: str,
+    sha: Optional[str] = None,
+    path: str = "",
+    depth: int = Query(default=1, ge=0),
+    offset: int = Query(default=0, ge=0),
+    limit: Optional[int] = Query(default=None, ge=1),
+    hash: bool = False,
+):
+    sha, root = await git_clone(owner, repo, sha)
+    try:
+        return {"sha": sha, **await tree_listing(root, path, depth, offset, limit, hash)}
+    finally:
+        await gh.clones.release(sha)
+
+@app.get("/clone/{owner}/{repo}/file")
+async def git_clone_file(
+    owner: str, repo: str, path: str, sha: Optional[str] = None,
+    range: Optional[str] = Header(default=None),
+):
+    sha, root = await git_clone(owner, repo, sha)
+    try:
+        response = await file_response(root, path, range)
+    except BaseException:
+        await gh.clones.release(sha)
+        raise
+    # the body is read after this returns, the tree stays pinned until it's sent
+    response.background = BackgroundTask(gh.clones.release, sha)
+    return response
 
 @app.post("/deploy/{owner}/{repo}")
+async def deploy(
+    owner:str, repo:str, port: int = 8080, env_vars: str = "DOCKER=1", sha: Optional[str] = None,
+    stream: Optional[StreamFormat] = None, wait: bool = False,
+):
+    """
+    Queues a build and deploy of the latest code (or the given commit) of a GitHub repository.
+    :param stream: Follow the deploy events as `ndjson` or `sse`.
+    :param wait: Wait for the deploy and return its result.
+    :return: The deploy job.
+    """
+    sha = await commit_sha(owner, repo, sha)
+    job = jobs.submit(
+        "deploy",
+        (owner, repo, sha),
+        lambda job: deploy_container_from_repo(owner, repo, port, env_vars, sha, log=job.log),
+    )
+    return await job_response(job, stream, wait)
+
+class DeployError(Exception):
+    """A deploy step got an error response"""
+
+
+async def ensure_dns_record(name: str) -> Dict[str, Any]:
+    """
+    Makes sure the A record of an app points at the docker host, with at most one Cloudflare write.
+    :return: The Cloudflare response and whether the record was created.
+    """
+    res = await cf.ensure_dns_record(name)
+    if not res.get("success"):
+        raise DeployError(res.get("errors"))
+    return {"result": res, "created": res["action"] == "created"}
+
+
 async def deploy_container_from_repo(
-    owner:str, repo:str, port: int = 8080, env_vars: str = "DOCKER=1"
+    owner:str, repo:str, port: int = 8080, env_vars: str = "DOCKER=1", sha: Optional[str] = None,
+    log: Optional[Log] = None,
 ):
+    """
+    Builds and deploys a GitHub repository as a step graph: the build and DNS record
+    run concurrently, the container is created and started once the image exists, and
+    only then is the nginx route switched to it. Completed steps are rolled back when a later one fails.
+    :return: The url, port, container, DNS response, route outcome and step timings, or the failed step and error.
+    """
     name = f"{owner}-{repo}"
-    image = await docker_build_from_github_tarball(owner, repo)
-    if "error" in image:
-        return image
     host_port = str(gen_port())
-    payload = {
-        "Image": image,
-        "Env": env_vars.split(","),
-        "ExposedPorts": {f"{str(port)}/tcp": {"HostPort": host_port}},
-        "HostConfig": {"PortBindings": {f"{str(port)}/tcp": [{"HostPort": host_port}]}},
-    }
-    container = await fetch(
-        f"{env.DOCKER_URL}/containers/create?name={name}",
-        "POST",
-        headers={"Content-Type": "application/json"},
-        json=payload,
+    previous_port = nginx.routes.routes.get(name)
+
+    async def build(results: Dict[str, Any]) -> str:
+        image = await docker_build_from_github_tarball(owner, repo, sha, log=log)
+        if isinstance(image, dict):
+            raise DeployError(image["error"])
+        return image
+
+    async def dns(results: Dict[str, Any]) -> Dict[str, Any]:
+        return await ensure_dns_record(name)
+
+    async def undo_dns(record: Dict[str, Any]) -> None:
+        if record["created"]:
+            await cf.delete_dns_record(record["result"]["result"]["id"])
+
+    async def undo_route(_: Any) -> None:
+        if previous_port is None:
+            await nginx.routes.remove(name)
+        else:
+            await nginx.routes.apply(name, previous_port)
+
+    async def route(results: Dict[str, Any]) -> Dict[str, Any]:
+        res = await nginx.routes.apply(name, int(host_port))
+        if res["changed"] and not res["reloaded"]:
+            # a rejected config was already restored, a failed reload left ours on disk
+            if not res.get("restored"):
+                await undo_route(res)
+            raise DeployError(f"nginx: {res.get('error')}")
+        return res
+
+    async def create(results: Dict[str, Any]) -> str:
+        payload = {
+            "Image": results["build"],
+            "Env": env_vars.split(","),
+            "Labels": {nginx.APP_LABEL: name},
+            "ExposedPorts": {f"{str(port)}/tcp": {"HostPort": host_port}},
+            "HostConfig": {"PortBindings": {f"{str(port)}/tcp": [{"HostPort": host_port}]}},
+        }
+        container = await d.engine.create(name, payload)
+        if "Id" not in container:
+            raise DeployError(container.get("message", container))
+        return container["Id"]
+
+    async def remove(container: str) -> None:
+        await d.engine.remove(container, force=True)
+
+    async def start(results: Dict[str, Any]) -> None:
+        res = await d.start_container(results["create"])
+        if isinstance(res, dict) and "message" in res:
+            raise DeployError(res["message"])
+
+    async def inspect(results: Dict[str, Any]) -> Dict[str, Any]:
+        return await d.get_container(results["create"])
+
+    pipeline = (
+        Pipeline(log)
+        .step("build", build)
+        .step("dns", dns, undo=undo_dns)
+        .step("create", create, after=["build"], undo=remove)
+        .step("start", start, after=["create"])
+        .step("route", route, after=["start"], undo=undo_route)
+        .step("inspect", inspect, after=["dns", "route"])
     )
     try:
-        _id = container["Id"]
-        await d.start_container(_id)
-        res = await cf.create_dns_record(name)
-        if res["success"] == False:
-            await cf.delete_dns_record(name)
-            res = await cf.create_dns_record(name)
-        nginx_config = Template(NGINX_CONFIG).render(id=name, port=host_port)
-        for path in ["/etc/nginx/conf.d","/etc/nginx/sites-enabled",
-    "/etc/nginx/sites-available"]:
-            try:
-                os.remove(f"{path}/{name}.conf")
-            except:
-                pass
-            with open(f"{path}/{name}.conf", "w") as f:
-                f.write(nginx_config)
-        os.system("nginx -s reload")
-        data = await d.get_container(_id)
-        return {
-            "url": f"{name}.smartpro.solutions",
-            "port": host_port,
-            "container": data,
-            "dns": res,
-        }
-    except KeyError:
-        return container
\ No newline at end of file
+        results = await pipeline.run()
+    except StepFailed as exc:
+        return {"error": str(exc.error), "step": exc.step, "timings": pipeline.timings}
+    return {
+        "url": f"{name}.smartpro.solutions",
+        "port": host_port,
+        "container": results["inspect"],
+        "dns": results["dns"]["result"],
+        "route": results["route"],
+        "timings": pipeline.timings,
+    }
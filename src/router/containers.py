@@ -1,5 +1,7 @@
-from fastapi import APIRouter
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query
 from src.api.docker import (
+    container_filters,
     create_container,
     delete_container,
     get_container,
@@ -7,41 +9,123 @@ from src.api.docker import (
     get_container_stats,
     get_containers,
     ContainerConfig,
-    fetch,
-    env
+    LifecycleRequest,
+    bulk_lifecycle,
+    engine,
 )
+from src.api.metrics import compute_sample, stats_sampler
+from src.api.state import container_index
+from src.streaming import StreamFormat, event_response
 
 app = APIRouter()
 
 
-#@app.put("/containers/{container}/start", tags=["containers"])
+@app.put("/containers/{container}/start", tags=["containers"])
 async def start_container_by_id(container: str):
-    return await fetch(f"{env.DOCKER_URL}/containers/{container}/start", "POST")
+    return await engine.start(container)
 
-#@app.put("/containers/{container}/stop", tags=["containers"])
-async def stop_container_by_id(container: str):
-    return await fetch(f"{env.DOCKER_URL}/containers/{container}/stop", "POST")
+@app.put("/containers/{container}/stop", tags=["containers"])
+async def stop_container_by_id(container: str, timeout: Optional[int] = Query(default=None, ge=0)):
+    return await engine.stop(container, timeout)
 
-#@app.put("/containers/{container}/restart", tags=["containers"])
-async def restart_container_by_id(container: str):
-    return await fetch(f"{env.DOCKER_URL}/containers/{container}/restart", "POST")
+@app.put("/containers/{container}/restart", tags=["containers"])
+async def restart_container_by_id(container: str, timeout: Optional[int] = Query(default=None, ge=0)):
+    return await engine.restart(container, timeout)
+
+@app.post("/containers:batch", tags=["containers"])
+async def batch_container_lifecycle(request: LifecycleRequest):
+    """
+    Start, stop, restart or remove many containers (by id/name and/or label/name selectors)
+    with bounded parallelism; one result per container.
+    """
+    return await bulk_lifecycle(request)
 
 
 @app.get("/containers", tags=["containers"])
-async def get_all_containers():
-    return await get_containers()
+async def get_all_containers(
+    label: Optional[List[str]] = Query(default=None),
+    status: Optional[List[str]] = Query(default=None),
+    name: Optional[List[str]] = Query(default=None),
+    ids: Optional[List[str]] = Query(default=None, alias="id"),
+    fields: Optional[List[str]] = Query(default=None),
+    inspect: bool = False,
+    offset: int = Query(default=0, ge=0),
+    limit: Optional[int] = Query(default=None, ge=1),
+    fresh: bool = False,
+):
+    filters = container_filters(label=label, status=status, name=name, ids=ids)
+    if container_index.synced and not fresh:
+        return container_index.list(
+            filters=filters, fields=fields, inspect=inspect, offset=offset, limit=limit
+        )
+    return await get_containers(
+        filters=filters, fields=fields, inspect=inspect, offset=offset, limit=limit
+    )
+
+@app.get("/containers/stats", tags=["containers"])
+async def get_all_container_stats(window: Optional[float] = Query(default=None, gt=0)):
+    """
+    Latest sample of every sampled container, with min/avg/max/p95 over the last `window` seconds.
+    """
+    return stats_sampler.all(window)
 
 @app.get("/containers/{container}", tags=["containers"])
-async def get_container_by_id(container: str):
+async def get_container_by_id(container: str, fresh: bool = False):
+    if container_index.synced and not fresh:
+        cached = container_index.get(container)
+        if cached is not None:
+            return cached
     return await get_container(container)
 
-#@app.get("/containers/{container}/logs", tags=["containers"])
-async def get_container_logs_by_id(container: str):
-    return await get_container_logs(container)
+@app.get("/containers/{container}/logs", tags=["containers"])
+async def get_container_logs_by_id(
+    container: str,
+    tail: Optional[int] = Query(default=None, ge=0),
+    since: Optional[int] = None,
+    until: Optional[int] = None,
+    follow: bool = False,
+    timestamps: bool = False,
+    stdout: bool = True,
+    stderr: bool = True,
+    stream: StreamFormat = StreamFormat.ndjson,
+):
+    """
+    Log lines of a container, streamed as they are read (and produced, with `follow`).
+    """
+    details = await get_container(container)
+    if not isinstance(details, dict) or "Id" not in details:
+        message = details.get("message") if isinstance(details, dict) else None
+        raise HTTPException(status_code=404, detail=message or f"No such container: {container}")
+    logs = get_container_logs(
+        details["Id"],
+        tty=bool((details.get("Config") or {}).get("Tty")),
+        tail=tail,
+        since=since,
+        until=until,
+        follow=follow,
+        timestamps=timestamps,
+        stdout=stdout,
+        stderr=stderr,
+    )
+    return event_response(logs, stream)
 
-#@app.get("/containers/{container}/stats", tags=["containers"])
-async def get_container_stats_by_id(container: str):
-    return await get_container_stats(container)
+@app.get("/containers/{container}/stats", tags=["containers"])
+async def get_container_stats_by_id(
+    container: str, window: Optional[float] = Query(default=None, gt=0), fresh: bool = False
+):
+    """
+    Latest sample of a container from the sampler, with min/avg/max/p95 over the last
+    `window` seconds. Containers that aren't sampled (or `fresh`) get a one-shot reading.
+    """
+    if not fresh:
+        summary = stats_sampler.summary(container, window)
+        if summary is not None:
+            return summary
+    raw = await get_container_stats(container)
+    if not isinstance(raw, dict) or "cpu_stats" not in raw:
+        message = raw.get("message") if isinstance(raw, dict) else None
+        raise HTTPException(status_code=404, detail=message or f"No such container: {container}")
+    return {"id": raw.get("id"), "name": (raw.get("name") or "").lstrip("/"), "latest": compute_sample(raw)}
 
 @app.post("/containers", tags=["containers"])
 async def create_new_container(name: str, config: ContainerConfig):
@@ -54,6 +138,10 @@ async def create_new_container(name: str, config: ContainerConfig):
         return container
     
 @app.delete("/containers/{container}", tags=["containers"])
-async def delete_container_by_id(container: str):
-    await stop_container_by_id(container)
+async def delete_container_by_id(
+    container: str, timeout: Optional[int] = Query(default=None, ge=0), force: bool = False
+):
+    if force:
+        return await delete_container(container, force=True)
+    await stop_container_by_id(container, timeout)
     return await delete_container(container)
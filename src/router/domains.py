@@ -1,5 +1,8 @@
+from typing import List
 from fastapi import APIRouter
 from src.api.cloudflare import (
+        DNSOperation,
+        batch_dns_records,
         create_dns_record,
         get_dns_records,
         delete_dns_record,
@@ -9,8 +12,8 @@ from src.api.cloudflare import (
 app = APIRouter()
 
 @app.get("/dns")
-async def get_all_dns_records():
-    return await get_dns_records()
+async def get_all_dns_records(fresh: bool = False):
+    return await get_dns_records(fresh=fresh)
 
 @app.post("/dns")
 async def create_new_dns_record(name: str):
@@ -23,3 +26,7 @@ async def update_dns_record_by_id(dns: str, name: str):
 @app.delete("/dns/{dns}")
 async def delete_dns_record_by_id(dns: str):
     return await delete_dns_record(dns)
+
+@app.post("/dns:batch")
+async def batch_dns(operations: List[DNSOperation]):
+    return await batch_dns_records(operations)
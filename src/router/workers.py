@@ -1,5 +1,8 @@
+from typing import List
 from fastapi import APIRouter
 from src.api.cloudflare import (
+    WorkerOperation,
+    batch_workers,
     create_worker,
     update_worker,
     invoke_worker,
@@ -14,12 +17,13 @@ async def get_all_workers():
     return await get_workers()
 
 @app.post("/workers", tags=["workers"])
-async def create_new_worker(name: str, script: str):
-    return await create_worker(name, script)
+async def create_new_worker(name: str, script: str, force: bool = False):
+    return await create_worker(name, script, force)
 
 @app.put("/workers/{worker}", tags=["workers"])
-async def update_worker_by_id(worker: str, script: str):
-    return await update_worker(worker, script)
+async def update_worker_by_id(worker: str, script: str, force: bool = False):
+    """Upload the script unless the same bytes are already deployed (`force` uploads anyway)"""
+    return await update_worker(worker, script, force)
 
 @app.post("/workers/{worker}", tags=["workers"])
 async def invoke_worker_by_id(worker: str):
@@ -27,4 +31,8 @@ async def invoke_worker_by_id(worker: str):
 
 @app.delete("/workers/{worker}", tags=["workers"])
 async def delete_worker_by_id(worker: str):
-    return await delete_worker(worker)  
\ No newline at end of file
+    return await delete_worker(worker)
+
+@app.post("/workers:batch", tags=["workers"])
+async def batch_worker_operations(operations: List[WorkerOperation]):
+    return await batch_workers(operations)
@@ -0,0 +1,42 @@
+"""Streaming responses for event producers (NDJSON or Server-Sent Events)"""
+import json
+from enum import Enum
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+from fastapi.responses import StreamingResponse
+
+
+class StreamFormat(str, Enum):
+    ndjson = "ndjson"
+    sse = "sse"
+
+
+async def tap(
+    events: AsyncIterator[Dict[str, Any]], log: Optional[Callable[[Dict[str, Any]], None]]
+) -> AsyncIterator[Dict[str, Any]]:
+    """Pass events through, handing each one to `log` first"""
+    async for event in events:
+        if log is not None:
+            log(event)
+        yield event
+
+
+async def ndjson(events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    async for event in events:
+        yield json.dumps(event).encode() + b"\n"
+
+
+async def sse(events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[bytes]:
+    async for event in events:
+        kind = event.get("type", "message")
+        yield f"event: {kind}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+def event_response(events: AsyncIterator[Dict[str, Any]], format: StreamFormat) -> StreamingResponse:
+    """Stream events to the client as they are produced"""
+    if format == StreamFormat.sse:
+        return StreamingResponse(
+            sse(events),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+    return StreamingResponse(ndjson(events), media_type="application/x-ndjson")
@@ -1,6 +1,9 @@
 """Utility functions for the API."""
 import os
 import socket
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Dict, Iterable, Iterator, List, Optional
 from uuid import uuid4
 from secrets import token_urlsafe
 from datetime import datetime
@@ -18,31 +21,100 @@ def get_dir_size(path="."):
     return total
 
 
-def build_file_tree(root_dir):
-    file_tree = {
-        "name": os.path.basename(root_dir),
+async def gather_limited(aws: Iterable[Awaitable[Any]], limit: int) -> List[Any]:
+    """Gather awaitables running at most `limit` of them at a time."""
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(aw: Awaitable[Any]) -> Any:
+        async with semaphore:
+            return await aw
+
+    return await asyncio.gather(*[run(aw) for aw in aws])
+
+
+def safe_join(root: str, path: str) -> str:
+    """Join a relative path to root, refusing anything that escapes it."""
+    root = os.path.realpath(root)
+    full = os.path.realpath(os.path.join(root, path.lstrip("/")))
+    if os.path.commonpath([root, full]) != root:
+        raise ValueError(f"Path outside of tree: {path}")
+    return full
+
+
+def file_hash(path: str, chunk_size: int = 1 << 16) -> str:
+    """SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def scan_tree(
+    root: str,
+    path: str = "",
+    depth: int = 1,
+    offset: int = 0,
+    limit: Optional[int] = None,
+    hash: bool = False,
+) -> Dict[str, Any]:
+    """
+    Metadata-only listing of a directory inside root.
+    Entries carry name, path, type, size and mtime (plus a sha256 when `hash` is set);
+    directories are expanded `depth` levels down. Every directory lists at most `limit`
+    children, starting at `offset` for the requested one, and reports its `total`.
+    """
+    full = safe_join(root, path)
+    base = os.path.realpath(root)
+
+    def node(entry: os.DirEntry, level: int, start: int) -> Dict[str, Any]:
+        stat = entry.stat(follow_symlinks=False)
+        item: Dict[str, Any] = {
+            "name": entry.name,
+            "path": os.path.relpath(entry.path, base),
+            "type": "directory" if entry.is_dir(follow_symlinks=False) else "file",
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+        }
+        if item["type"] == "directory":
+            if level > 0:
+                item.update(children(entry.path, level, start))
+        elif hash and entry.is_file(follow_symlinks=False):
+            item["sha256"] = file_hash(entry.path)
+        return item
+
+    def children(directory: str, level: int, start: int) -> Dict[str, Any]:
+        with os.scandir(directory) as it:
+            entries = sorted(it, key=lambda e: (not e.is_dir(follow_symlinks=False), e.name))
+        end = start + limit if limit is not None else None
+        return {
+            "total": len(entries),
+            "children": [node(entry, level - 1, 0) for entry in entries[start:end]],
+        }
+
+    tree: Dict[str, Any] = {
+        "name": os.path.basename(full),
+        "path": os.path.relpath(full, base),
         "type": "directory",
-        "children": [],
     }
-
-    for file_name in os.listdir(root_dir):
-        file_path = os.path.join(root_dir, file_name)
-
-        if os.path.isdir(file_path):
-            file_tree["children"].append(build_file_tree(file_path))
-        else:
-            try:
-                with open(file_path, "r") as f:
-                    file_content = f.read()
-            except UnicodeDecodeError:
-                with open(file_path, "rb") as f:
-                    file_content = f.read()
-
-            file_tree["children"].append(
-                {"name": file_name, "type": "file", "content": file_content}
-            )
-
-    return file_tree
+    tree.update(children(full, depth, offset))
+    return tree
+
+
+def read_file_range(
+    path: str, start: int = 0, end: Optional[int] = None, chunk_size: int = 1 << 16
+) -> Iterator[bytes]:
+    """Yield the bytes of a file between start and end (inclusive) in chunks."""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = None if end is None else end - start + 1
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
 
 
 def gen_oid() -> str: